@@ -1,9 +1,24 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from gspread.utils import rowcol_to_a1
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import json
+import io
+import logging
+import math
+import threading
+import time
+from storage import (COUNTER_HEADERS, COUNTER_SHEET, DATE_COLUMNS, DATE_FORMAT, HEADERS, ChangeWatcher, PendingWritesError,
+                     SiteVersions, SQLiteMirror, SyncWorker, WriteQueue, append_rows, append_with_backoff,
+                     appended_row_number, apply_write, counter_update, create_backend, is_retryable, locate_rows,
+                     new_version, read_counters, read_setting, renumber_duplicate_ids, values_frame, with_backoff,
+                     write_rows)
+from search import SearchIndex
+import metrics
+
+logger = logging.getLogger("factory_tracker.app")
 
 st.set_page_config(
     page_title="Octa Services - Factory Tracker",
@@ -173,81 +188,1011 @@ PRIORITIES = ["Low", "Medium", "High", "CRITICAL"]
 
 STATUSES = ["🔴 OPEN", "🟡 IN PROGRESS", "🟢 RESOLVED"]
 
+ACTIVE_STATUSES = ["🔴 OPEN", "🟡 IN PROGRESS"]
+
+CATEGORY_COLUMNS = {'Status': STATUSES, 'Priority': PRIORITIES, 'Line_Number': LINES,
+                    'Assigned_Engineer': ENGINEERS, 'Submitted_By_Engineer': ENGINEERS}
+
+DATE_COLUMN_CONFIG = {column: st.column_config.DateColumn(column, format="DD/MM/YYYY") for column in DATE_COLUMNS}
+
+LAST_COLUMN = rowcol_to_a1(1, len(HEADERS))[:-1]
+
+def get_setting(name, default):
+    return read_setting(st.secrets, name, default)
+
+# Seconds a site snapshot is served from memory before the worksheet is read again
+DATA_TTL_SECONDS = get_setting("DATA_TTL_SECONDS", 60)
+
+# Between full reloads a stale snapshot only fetches appended rows and the rows that are still active
+FULL_SYNC_SECONDS = get_setting("FULL_SYNC_SECONDS", 900)
+SYNC_MAX_RANGES = 50
+
+# "sheets" reads and writes Google Sheets directly; "sqlite" serves reads from a local mirror
+# and pushes writes to Sheets from a background worker; "shared" uses a mirror that several app
+# processes share, and only sync_service.py talks to Sheets
+STORAGE_BACKEND = get_setting("STORAGE_BACKEND", "sheets")
+SQLITE_PATH = get_setting("SQLITE_PATH", "factory_tracker.db")
+MIRRORED = STORAGE_BACKEND in ("sqlite", "shared")
+
+# How long a shared-mode page waits for the sync service to mirror a site it has not loaded yet
+SHARED_WAIT_SECONDS = get_setting("SHARED_WAIT_SECONDS", 30)
+
+# Resolved problems older than this move to monthly archive worksheets when an archive run is started
+ARCHIVE_AFTER_DAYS = get_setting("ARCHIVE_AFTER_DAYS", 365)
+APPEND_CHUNK_ROWS = 500
+
+# Timings of every run are appended to this JSON-lines file (rotated at 5 MB, "" turns it off);
+# SHOW_METRICS adds the performance panel to the sidebar
+METRICS_LOG = get_setting("METRICS_LOG", "metrics.jsonl")
+SHOW_METRICS = get_setting("SHOW_METRICS", False)
+
+# How often the background watcher polls the site versions for dashboards with live updates on
+LIVE_REFRESH_SECONDS = get_setting("LIVE_REFRESH_SECONDS", 15)
+
+@st.cache_resource
+def get_backend():
+    # Authorized once per process; worksheet handles and data snapshots are cached separately per site.
+    # Every call through the returned backend and its worksheets is timed into the current run's metrics.
+    with metrics.timed("sheets", "authorize"):
+        backend = create_backend(st.secrets)
+    return metrics.TimedBackend(backend)
+
 @st.cache_resource
 def get_google_sheet(site):
-    scope = ['https://spreadsheets.google.com/feeds',
-             'https://www.googleapis.com/auth/drive']
+    return get_backend().open_worksheet(site, HEADERS)
+
+@st.cache_resource
+def get_counter_sheet():
+    return get_backend().open_worksheet(COUNTER_SHEET, COUNTER_HEADERS,
+                                        rows=len(SITES) + 1, cols=3)
+
+@st.cache_resource
+def get_data_cache():
+    # Shared across sessions and reruns: {site: {"df", "loaded_at"}} plus one lock per site
+    return {"sites": {}, "locks": {}, "lock": threading.Lock(),
+            "counter_rows": {}, "id_lock": threading.Lock(), "search": {}, "versions": SiteVersions(DATA_TTL_SECONDS),
+            "archives": {}, "archive_titles": None, "derived": {}}
+
+def get_site_lock(site):
+    cache = get_data_cache()
+    with cache["lock"]:
+        return cache["locks"].setdefault(site, threading.Lock())
+
+def build_dataframe(all_values):
+    return apply_schema(values_frame(all_values))
+
+def apply_schema(df):
+    # Typed once per snapshot: an integer ID, categoricals for the enumerated columns (values outside
+    # the known lists become extra categories) and datetimes for the dates (blank or malformed -> NaT)
+    if 'Submission_ID' in df.columns:
+        df['Submission_ID'] = pd.to_numeric(df['Submission_ID'], errors='coerce').fillna(0).astype(int)
+    for column, known in CATEGORY_COLUMNS.items():
+        if column in df.columns:
+            extra = sorted(set(df[column].dropna().astype(str)) - set(known))
+            df[column] = pd.Categorical(df[column], categories=known + extra)
+    for column in DATE_COLUMNS:
+        if column in df.columns and not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], format=DATE_FORMAT, errors='coerce')
+    return df
+
+def format_date(value):
+    if pd.isna(value) or value == "":
+        return ""
+    return value.strftime(DATE_FORMAT) if hasattr(value, "strftime") else str(value)
+
+def fetch_site_values(site):
+    sheet = get_google_sheet(site)
+    all_values = sheet.get_all_values()
+    if len(all_values) == 0:
+        sheet.append_row(HEADERS)
+        all_values = [HEADERS]
+    return all_values
+
+def invalidate_data(site=None):
+    cache = get_data_cache()
+    with cache["lock"]:
+        if site is None:
+            cache["sites"].clear()
+        else:
+            cache["sites"].pop(site, None)
+
+def build_row_index(df):
+    # Submission_ID -> worksheet row; the snapshot's index is always the sheet row minus 2
+    return dict(zip(df['Submission_ID'], df.index + 2))
+
+def row_spans(row_numbers, max_gap=10):
+    # Group sorted row numbers into [first, last] spans, bridging small gaps to keep the range count low
+    spans = []
+    for row in sorted(row_numbers):
+        if spans and row - spans[-1][1] <= max_gap + 1:
+            spans[-1][1] = row
+        else:
+            spans.append([row, row])
+    return spans
+
+def values_block(columns, values, first_row):
+    block = build_dataframe([columns] + values)
+    block.index = range(first_row - 2, first_row - 2 + len(block))
+    return block
+
+def sync_snapshot(site, entry):
+    # One batch_get: every row after the high-water mark plus the spans holding active problems
+    df = entry["df"]
+    active_rows = (df.index[df['Status'] != '🟢 RESOLVED'] + 2).tolist()
+    spans = row_spans(active_rows)
+    if len(spans) > SYNC_MAX_RANGES:
+        return None
     
-    creds_dict = json.loads(st.secrets["GOOGLE_SHEET_CREDENTIALS"])
-    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-    client = gspread.authorize(creds)
+    # The open range starts on the last loaded row, not after it: Sheets refuses a range that starts past
+    # the end of the grid, and that row must still hold the ID we cached
+    ranges = [f"A{entry['last_row']}:{LAST_COLUMN}"] + [f"A{first}:{LAST_COLUMN}{last}" for first, last in spans]
+    try:
+        tail_values, *active_values = get_google_sheet(site).batch_get(ranges)
+    except gspread.exceptions.APIError as e:
+        # A span past the end of the grid: rows were deleted, so the full reload takes over
+        if is_retryable(e):
+            raise
+        return None
     
-    spreadsheet = client.open_by_key("1urBkSsjlV2rO-uPbwbyKcjE_fl2lGnRD6tgNQEcXIMc")
+    columns = list(df.columns)
+    if entry["last_row"] > 1:
+        overlap = values_block(columns, tail_values[:1], entry["last_row"])
+        if overlap.empty or not overlap['Submission_ID'].equals(df['Submission_ID'].reindex(overlap.index)):
+            return None
+    new_values = tail_values[1:]
     
+    blocks = []
+    for (first, last), values in zip(spans, active_values):
+        block = values_block(columns, values, first)
+        # A row that no longer holds the ID we cached means rows were moved or deleted
+        if len(block) != last - first + 1 or not block['Submission_ID'].equals(df['Submission_ID'].reindex(block.index)):
+            return None
+        blocks.append(block)
+    
+    new_rows = values_block(columns, new_values, entry["last_row"] + 1)
+    if not new_rows.empty:
+        blocks.append(new_rows)
+    
+    if blocks:
+        changed = pd.concat(blocks)
+        df = apply_schema(pd.concat([df.drop(changed.index, errors='ignore'), changed]).sort_index())
+    return {**entry,
+            "df": df,
+            "row_index": {**entry["row_index"], **build_row_index(new_rows)},
+            "last_row": entry["last_row"] + len(new_rows),
+            "loaded_at": time.time()}
+
+def reassign_duplicate_ids(site, entry):
+    # Outside shared mode two processes that read the counter at the same moment hand out the same ID.
+    # A failed attempt is retried on the next load; one Sheets refuses for good is logged for a person.
+    if not entry["df"]['Submission_ID'].duplicated().any():
+        return entry
     try:
-        sheet = spreadsheet.worksheet(site)
-    except:
-        sheet = spreadsheet.add_worksheet(title=site, rows="1000", cols="20")
-        headers = [
-            'Submission_ID', 'Line_Number', 'Date_Submitted', 'Task', 
-            'Spare_Parts_Data', 'Priority', 'Notes', 'Status', 
-            'Submitted_By_Engineer', 'Expected_Due_Date', 'Troubleshooting_Steps',
-            'Assigned_Engineer', 'Date_Resolved', 'Resolution_Notes'
-        ]
-        sheet.append_row(headers)
-    
-    return sheet
-
-def load_data(site):
-    sheet = get_google_sheet(site)
-    try:
-        all_values = sheet.get_all_values()
-        
-        if len(all_values) == 0:
-            headers = [
-                'Submission_ID', 'Line_Number', 'Date_Submitted', 'Task', 
-                'Spare_Parts_Data', 'Priority', 'Notes', 'Status', 
-                'Submitted_By_Engineer', 'Expected_Due_Date', 'Troubleshooting_Steps',
-                'Assigned_Engineer', 'Date_Resolved', 'Resolution_Notes'
-            ]
-            sheet.append_row(headers)
-            return pd.DataFrame(columns=headers)
+        new_ids = renumber_duplicate_ids(get_google_sheet(site), entry["df"],
+                                         lambda count: allocate_submission_ids(site, count))
+    except Exception as e:
+        if is_retryable(e):
+            logger.warning("Could not renumber the duplicate IDs in %s yet: %s", site, e)
+        else:
+            logger.exception("Could not renumber the duplicate IDs in %s", site)
+        return entry
+    if not new_ids:
+        return entry
+    df = entry["df"].copy()
+    df.loc[[row - 2 for row in new_ids], 'Submission_ID'] = list(new_ids.values())
+    return {**entry, "df": df, "row_index": build_row_index(df)}
+
+def load_snapshot(site, max_age=None):
+    max_age = DATA_TTL_SECONDS if max_age is None else max_age
+    cache = get_data_cache()
+    
+    entry = cache["sites"].get(site)
+    if entry is not None and time.time() - entry["loaded_at"] < max_age:
+        return entry
+    
+    # Only one session per site goes to the API; the others wait and reuse its snapshot
+    with get_site_lock(site):
+        entry = cache["sites"].get(site)
+        if entry is not None and time.time() - entry["loaded_at"] < max_age:
+            return entry
         
-        elif len(all_values) == 1:
-            return pd.DataFrame(columns=all_values[0])
+        if entry is not None and time.time() - entry["full_loaded_at"] < FULL_SYNC_SECONDS:
+            with metrics.timed("dataframe", "sync_snapshot"):
+                synced = sync_snapshot(site, entry)
+            if synced is not None:
+                synced = cache["sites"][site] = reassign_duplicate_ids(site, synced)
+                return synced
         
-        else:
-            data = sheet.get_all_records()
-            return pd.DataFrame(data)
-            
+        all_values = fetch_site_values(site)
+        with metrics.timed("dataframe", "build_dataframe"):
+            df = build_dataframe(all_values)
+        now = time.time()
+        entry = {"df": df, "row_index": build_row_index(df), "last_row": len(all_values),
+                 "loaded_at": now, "full_loaded_at": now}
+        entry = cache["sites"][site] = reassign_duplicate_ids(site, entry)
+        return entry
+
+def load_site_frame(site, max_age=None):
+    if MIRRORED:
+        return apply_schema(get_site_mirror(site).read_site(site))
+    return load_snapshot(site, max_age)["df"]
+
+def load_data(site, max_age=None):
+    try:
+        return load_site_frame(site, max_age)
+    except Exception as e:
+        st.error(f"❌ Error loading data: {str(e)}")
+        return pd.DataFrame(columns=HEADERS)
+
+def load_all_sites(sites):
+    # One thread per site, so the wait is the slowest site rather than the sum; returns (frames, errors)
+    ctx = get_script_run_ctx()
+    run = metrics.current_run()
+    
+    def load(site):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        metrics.attach(run)
+        return load_site_frame(site)
+    
+    with ThreadPoolExecutor(max_workers=len(sites)) as pool:
+        futures = {site: pool.submit(load, site) for site in sites}
+    
+    frames, errors = {}, {}
+    for site, future in futures.items():
+        try:
+            frames[site] = future.result()
+        except Exception as e:
+            errors[site] = e
+    return frames, errors
+
+def filter_problems(df, **filters):
+    # filters: {column: value or list of values}; None and "All" mean no filter
+    mask = pd.Series(True, index=df.index)
+    for column, value in filters.items():
+        if value is None or value == "All":
+            continue
+        values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+        mask &= df[column].isin(values)
+    return df[mask]
+
+HISTORY_SORT_ORDERS = ["Newest first", "Oldest first", "Recently resolved", "Priority (CRITICAL first)"]
+
+def sort_problems(df, order, scores=None):
+    if order == "Relevance" and scores:
+        return df.iloc[(-df['Submission_ID'].map(scores).fillna(0)).argsort(kind='stable')]
+    if order == "Oldest first":
+        return df.sort_values('Submission_ID')
+    if order == "Recently resolved":
+        return df.sort_values('Date_Resolved', ascending=False, na_position='last', kind='stable')
+    if order == "Priority (CRITICAL first)":
+        rank = pd.Categorical(df['Priority'], categories=PRIORITIES).codes
+        return df.iloc[(-rank).argsort(kind='stable')]
+    return df.sort_values('Submission_ID', ascending=False)
+
+def query_problems(site, **filters):
+    if MIRRORED:
+        try:
+            return apply_schema(get_site_mirror(site).query(site, **filters))
+        except Exception as e:
+            st.error(f"❌ Error loading data: {str(e)}")
+            return pd.DataFrame(columns=HEADERS)
+    return filter_problems(load_data(site), **filters)
+
+def mirror_derived(site, name, build, stamp=None):
+    # In the mirrored modes: build(df) memoized on the mirror's version of the site, which changes with
+    # every pull that brought changes and every write, so reruns reuse the result until then. stamp is
+    # anything else the result depends on.
+    mirror = get_site_mirror(site)
+    key = (mirror.site_versions().get(site), stamp)
+    cache = get_data_cache()
+    cached = cache["derived"].get((site, name))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    df = load_site_frame(site)
+    with metrics.timed("dataframe", name):
+        result = build(df)
+    cache["derived"][(site, name)] = (key, result)
+    return result
+
+def get_search_index(site):
+    # One index per site, kept across snapshots; syncing only re-indexes rows whose text changed
+    cache = get_data_cache()
+    with cache["lock"]:
+        index = cache["search"].setdefault(site, SearchIndex())
+    df = load_data(site)
+    with metrics.timed("dataframe", "search_index"):
+        index.sync(df)
+    return index
+
+def search_problems(site, query, limit=None):
+    return dict(get_search_index(site).search(query, limit))
+
+PART_PATTERN = r"^(?P<Part_Number>[^:]*):(?P<Part_Name>.*):Qty(?P<Quantity>\d+):Stock-(?P<Stock>.*)$"
+
+def parse_spare_parts(df):
+    # "number:name:QtyN:Stock-X | ..." -> one row per part keyed by Submission_ID
+    listed = df.loc[~df['Spare_Parts_Data'].isin(["N/A", ""]), ['Submission_ID', 'Spare_Parts_Data']]
+    exploded = listed.assign(Part=listed['Spare_Parts_Data'].str.split(" | ", regex=False)).explode('Part')
+    raw = exploded['Part'].fillna("").str.strip()
+    parts = raw.str.extract(PART_PATTERN)
+    # A part that does not follow the format keeps its raw text as the part number
+    parts['Part_Number'] = parts['Part_Number'].fillna(raw)
+    parts['Part_Name'] = parts['Part_Name'].fillna("")
+    parts['Quantity'] = pd.to_numeric(parts['Quantity'], errors='coerce').fillna(0).astype(int)
+    parts['Stock'] = parts['Stock'].fillna("")
+    parts.insert(0, 'Submission_ID', exploded['Submission_ID'])
+    return parts[raw != ""].reset_index(drop=True)
+
+def derive(entry, name, build):
+    # Memoizes build(df) on a snapshot entry; entries copied for a newer df recompute it
+    cached = entry.get(name)
+    if cached is None or cached[0] is not entry["df"]:
+        with metrics.timed("dataframe", name.split(" ")[0]):
+            cached = (entry["df"], build(entry["df"]))
+        entry[name] = cached
+    return cached[1]
+
+SUMMARY_COLUMNS = ['Line_Number', 'Status', 'Priority']
+
+def summarize_problems(df):
+    # Problem counts by line x status x priority in one group-by
+    return df.groupby(SUMMARY_COLUMNS, observed=True).size()
+
+def load_summary(site):
+    try:
+        if MIRRORED:
+            return get_site_mirror(site).count_by(site, SUMMARY_COLUMNS)
+        return derive(load_snapshot(site), "summary", summarize_problems)
+    except Exception as e:
+        st.error(f"❌ Error loading data: {str(e)}")
+        return summarize_problems(pd.DataFrame(columns=HEADERS))
+
+# The Update page's picker lists at most this many matches; the rest are reached by filtering or typing
+PICKER_MATCHES = 25
+
+def problem_lookup(df):
+    # Active problems indexed by Submission_ID with their picker label, so a selection resolves with one
+    # index lookup instead of a scan
+    # Rows still waiting for their ID (0, or a negative placeholder in the mirror) cannot be updated yet
+    active = df[(df['Status'] != '🟢 RESOLVED') & (df['Submission_ID'] > 0)]
+    active = active[~active['Submission_ID'].duplicated(keep='last')]
+    labels = ("ID #" + active['Submission_ID'].astype(str) + " - " + active['Line_Number'].astype(str)
+              + " - " + active['Task'].astype(str).str[:50] + "...")
+    lookup = active.assign(Label=labels)
+    lookup.index = active['Submission_ID'].to_numpy()
+    return lookup
+
+def load_problem_lookup(site):
+    try:
+        if MIRRORED:
+            return problem_lookup(query_problems(site, Status=ACTIVE_STATUSES))
+        return derive(load_snapshot(site), "lookup", problem_lookup)
     except Exception as e:
         st.error(f"❌ Error loading data: {str(e)}")
-        return pd.DataFrame(columns=[
-            'Submission_ID', 'Line_Number', 'Date_Submitted', 'Task', 
-            'Spare_Parts_Data', 'Priority', 'Notes', 'Status', 
-            'Submitted_By_Engineer', 'Expected_Due_Date', 'Troubleshooting_Steps',
-            'Assigned_Engineer', 'Date_Resolved', 'Resolution_Notes'
-        ])
+        return problem_lookup(apply_schema(pd.DataFrame(columns=HEADERS)))
+
+def pick_problems(site, lookup, text="", **filters):
+    # Returns (best matches, number of matches): a typed ID first, then search relevance; without
+    # text the most urgent problems come first
+    matches = filter_problems(lookup, **filters)
+    if text:
+        scores = search_problems(site, text)
+        typed_id = text.lstrip("#")
+        if typed_id.isdigit() and int(typed_id) in matches.index:
+            scores[int(typed_id)] = float("inf")
+        matches = sort_problems(matches[matches.index.isin(list(scores))], "Relevance", scores)
+    else:
+        matches = sort_problems(matches, "Priority (CRITICAL first)")
+    return matches.head(PICKER_MATCHES), len(matches)
+
+ANALYTICS_DIMENSIONS = {"Line": 'Line_Number', "Priority": 'Priority', "Engineer": 'Assigned_Engineer'}
+
+def week_start(dates):
+    return dates.dt.to_period('W-SUN').dt.start_time
+
+def resolution_stats(days, groups):
+    stats = days.groupby(groups, observed=True).agg(['count', 'mean', 'median'])
+    quantiles = days.groupby(groups, observed=True).quantile([0.75, 0.9]).unstack()
+    stats[['p75', 'p90']] = quantiles.to_numpy() if not quantiles.empty else float('nan')
+    stats.columns = ['Resolved', 'Mean Days', 'Median Days', 'P75 Days', 'P90 Days']
+    return stats.round(1)
+
+def analyze_problems(df, today):
+    # Time-to-resolve, overdue and weekly trends from the typed date columns
+    resolved = df[(df['Status'] == '🟢 RESOLVED') & df['Date_Resolved'].notna() & df['Date_Submitted'].notna()]
+    days = (resolved['Date_Resolved'] - resolved['Date_Submitted']).dt.days
+    resolved, days = resolved[days >= 0], days[days >= 0]
+    
+    active = df[df['Status'].isin(ACTIVE_STATUSES)]
+    overdue = active[active['Expected_Due_Date'] < today]
+    overdue = (overdue.assign(Days_Overdue=(today - overdue['Expected_Due_Date']).dt.days)
+                      .sort_values('Days_Overdue', ascending=False))
+    
+    trends = pd.DataFrame({
+        "Submitted": week_start(df['Date_Submitted']).value_counts(),
+        "Resolved": week_start(resolved['Date_Resolved']).value_counts(),
+        "Mean Days to Resolve": days.groupby(week_start(resolved['Date_Resolved'])).mean().round(1)
+    }).sort_index()
+    trends[["Submitted", "Resolved"]] = trends[["Submitted", "Resolved"]].fillna(0).astype(int)
+    
+    return {"days": days,
+            "by": {name: resolution_stats(days, resolved[column]) for name, column in ANALYTICS_DIMENSIONS.items()},
+            "overdue": overdue,
+            "trends": trends}
+
+def load_analytics(site):
+    today = pd.Timestamp(datetime.now().date())
+    try:
+        if MIRRORED:
+            return mirror_derived(site, "analytics", lambda df: analyze_problems(df, today), stamp=today)
+        # Memoized per snapshot and day, so switching views reuses the same result; one entry per
+        # snapshot, replaced when the day changes
+        entry = load_snapshot(site)
+        cached = entry.get("analytics")
+        if cached is None or cached[0] is not entry["df"] or cached[1] != today:
+            with metrics.timed("dataframe", "analytics"):
+                cached = (entry["df"], today, analyze_problems(entry["df"], today))
+            entry["analytics"] = cached
+        return cached[2]
+    except Exception as e:
+        st.error(f"❌ Error loading analytics: {str(e)}")
+        return analyze_problems(build_dataframe([HEADERS]), today)
+
+def snapshot_parts(entry):
+    # Parsed once per snapshot; a newer snapshot only re-parses rows whose parts text or ID changed
+    df = entry["df"]
+    cached = entry.get("parts")
+    if cached is not None and cached[0] is df:
+        return cached[1]
+    
+    started = time.perf_counter()
+    if cached is None:
+        parts = parse_spare_parts(df)
+    else:
+        previous_df, previous_parts = cached
+        changed = ((df['Spare_Parts_Data'] != previous_df['Spare_Parts_Data'].reindex(df.index)) |
+                   (df['Submission_ID'] != previous_df['Submission_ID'].reindex(df.index)))
+        kept = previous_parts['Submission_ID'].isin(df.loc[~changed, 'Submission_ID'])
+        parts = pd.concat([previous_parts[kept], parse_spare_parts(df[changed])], ignore_index=True)
+    entry["parts"] = (df, parts)
+    metrics.record("dataframe", "spare_parts", time.perf_counter() - started)
+    return parts
+
+def load_spare_parts(site):
+    try:
+        if MIRRORED:
+            return mirror_derived(site, "spare_parts", parse_spare_parts)
+        return snapshot_parts(load_snapshot(site))
+    except Exception as e:
+        st.error(f"❌ Error loading spare parts: {str(e)}")
+        return parse_spare_parts(pd.DataFrame(columns=HEADERS))
+
+def format_part(part):
+    if not part['Part_Name'] and not part['Stock']:
+        return part['Part_Number']
+    return f"{part['Part_Number']} - {part['Part_Name']} - Qty{part['Quantity']} - Stock-{part['Stock']}"
+
+def parts_demand(parts, problems):
+    # Quantity required per part number across the given problems, with the share not in stock
+    demand = parts.merge(problems[['Submission_ID']], on='Submission_ID')
+    demand = demand.assign(Out_Of_Stock=demand['Quantity'].where(demand['Stock'] == "No", 0))
+    return (demand.groupby('Part_Number', as_index=False)
+                  .agg(Part_Name=('Part_Name', 'first'),
+                       Quantity=('Quantity', 'sum'),
+                       Out_Of_Stock=('Out_Of_Stock', 'sum'),
+                       Problems=('Submission_ID', 'nunique'))
+                  .sort_values(['Quantity', 'Part_Number'], ascending=[False, True]))
+
+def blocking_parts(parts, problems):
+    # Out-of-stock parts holding up the given problems, one row per part with the problems it blocks
+    blocked = parts[parts['Stock'] == "No"].merge(problems[['Submission_ID', 'Line_Number']], on='Submission_ID')
+    ids = blocked['Submission_ID'].astype(str).radd("#")
+    return (blocked.assign(Problem=ids)
+                   .groupby('Part_Number', as_index=False)
+                   .agg(Part_Name=('Part_Name', 'first'),
+                        Quantity=('Quantity', 'sum'),
+                        Problems=('Problem', ", ".join),
+                        Lines=('Line_Number', lambda lines: ", ".join(sorted(set(lines)))))
+                   .sort_values(['Quantity', 'Part_Number'], ascending=[False, True]))
+
+def append_cached_row(site, row_number, data):
+    cache = get_data_cache()
+    with cache["lock"]:
+        entry = cache["sites"].get(site)
+        if entry is None:
+            return
+        new_row = values_block(list(entry["df"].columns), [[str(value) for value in data]], row_number)
+        df = entry["df"].drop(new_row.index, errors='ignore')
+        df = apply_schema(pd.concat([df, new_row]).sort_index()) if not df.empty else new_row
+        row_index = {**entry["row_index"], **build_row_index(new_row)}
+        # Only advance the high-water mark if no other writer appended in between
+        last_row = row_number if row_number == entry["last_row"] + 1 else entry["last_row"]
+        cache["sites"][site] = {**entry, "df": df, "row_index": row_index, "last_row": last_row}
+
+def append_problem_rows(rows, site, retried=False):
+    # A single row is patched into the cached snapshot; a batch of rows is picked up by the next load
+    appended = append_rows(get_google_sheet(site), rows, retried)
+    if len(rows) == 1 and appended:
+        append_cached_row(site, appended[int(rows[0][0])], rows[0])
+    else:
+        invalidate_data(site)
 
 def save_problem(data, site):
+    # Returns (submission_id, queued). A queued problem is safe in the local outbox and is pushed to
+    # Sheets by the sync worker; if no ID could be allocated yet it gets one when it is pushed.
     try:
-        sheet = get_google_sheet(site)
-        sheet.append_row(data)
-        st.cache_resource.clear()
+        with metrics.timed("write", "save_problem"):
+            queue, worker = get_write_queue()
+            
+            if MIRRORED:
+                # The row goes to SQLite even when Sheets cannot hand out an ID right now; push_write
+                # allocates it then
+                try:
+                    data = [with_backoff(lambda: allocate_submission_ids(site))[0]] + list(data[1:])
+                except Exception as e:
+                    if not is_retryable(e):
+                        raise
+                queue.append(site, data)
+                if worker is not None:
+                    worker.notify()
+                return data[0] or None, not data[0]
+            
+            appending = False
+            try:
+                data = [with_backoff(lambda: allocate_submission_ids(site))[0]] + list(data[1:])
+                if queue.has_pending(site):
+                    raise PendingWritesError(site)
+                appending = True
+                append_with_backoff(lambda retried: append_problem_rows([data], site, retried))
+                return data[0], False
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                # A failed append may still have landed, so pushing it checks column A first
+                queue.queue_append(site, data, attempts=int(appending))
+                worker.notify()
+                return data[0] or None, True
     except Exception as e:
         st.error(f"❌ Error saving problem: {str(e)}")
         raise e
 
-def update_problem(row_index, updates, site):
+def get_counter_row(site):
+    cache = get_data_cache()
+    if site in cache["counter_rows"]:
+        return cache["counter_rows"][site]
+    
+    counter_sheet = get_counter_sheet()
+    sites = counter_sheet.col_values(1)
+    if site in sites:
+        row = sites.index(site) + 1
+    else:
+        # First allocation for this site: seed the counter from the highest existing ID (one column read, once)
+        existing_ids = pd.to_numeric(pd.Series(get_google_sheet(site).col_values(1)[1:], dtype=object), errors='coerce')
+        last_id = int(existing_ids.max()) if existing_ids.notna().any() else 0
+        response = counter_sheet.append_row([site, last_id])
+        row = appended_row_number(response)
+    
+    cache["counter_rows"][site] = row
+    return row
+
+def allocate_submission_ids(site, count=1):
+    # In shared mode the mirror hands out IDs in one transaction across processes; the sync service
+    # writes the counter back to Sheets. Sheets has no compare-and-set, so otherwise allocations are
+    # serialized within the process, and an ID two processes handed out at once is reassigned by
+    # reassign_duplicate_ids when the site is next loaded.
+    if STORAGE_BACKEND == "shared":
+        return get_site_mirror(site).allocate_ids(site, count)
+    with get_data_cache()["id_lock"]:
+        counter_sheet = get_counter_sheet()
+        row = get_counter_row(site)
+        last_id = int(counter_sheet.acell(f"B{row}").value or 0)
+        # The new version goes out with the counter, so appending the rows needs no write of its own
+        counter_sheet.batch_update([counter_update(row, new_version(), last_id + count)])
+    return list(range(last_id + 1, last_id + count + 1))
+
+def bump_site_version(site):
+    # Tells the change watchers of every process that the site changed. A missed bump only delays the
+    # change until the next full sync, so it never fails the write itself.
     try:
-        sheet = get_google_sheet(site)
-        for col, value in updates.items():
-            sheet.update_cell(row_index + 2, col, value)
-        st.cache_resource.clear()
+        get_counter_sheet().batch_update([counter_update(get_counter_row(site), new_version())])
+    except Exception:
+        pass
+
+def resolve_rows(site, problem_ids):
+    # Rows come from the snapshot's index; once they moved under us the snapshot is dropped
+    return locate_rows(get_google_sheet(site), problem_ids, load_snapshot(site)["row_index"],
+                       reread=lambda row_index: invalidate_data(site))
+
+def patch_cached_rows(site, rows, row_updates):
+    cache = get_data_cache()
+    with cache["lock"]:
+        entry = cache["sites"].get(site)
+        if entry is None:
+            return
+        df = entry["df"].copy()
+        for problem_id, updates in row_updates.items():
+            row_number = rows[problem_id]
+            if entry["row_index"].get(problem_id) != row_number:
+                cache["sites"].pop(site, None)
+                return
+            for col, value in updates.items():
+                column = HEADERS[col - 1]
+                if column in DATE_COLUMNS:
+                    value = pd.to_datetime(value, format=DATE_FORMAT, errors='coerce')
+                elif isinstance(df[column].dtype, pd.CategoricalDtype) and value not in df[column].cat.categories:
+                    df[column] = df[column].cat.add_categories([value])
+                df.at[row_number - 2, column] = value
+        cache["sites"][site] = {**entry, "df": df}
+
+def update_rows(row_updates, site):
+    # row_updates: {submission_id: {column_number: value}} written in a single Sheets request
+    row_updates = {int(problem_id): dict(updates) for problem_id, updates in row_updates.items() if updates}
+    if not row_updates:
+        return {}
+    
+    rows = resolve_rows(site, list(row_updates))
+    try:
+        # The rows and the site's new version in one request
+        counter = counter_update(get_counter_row(site), new_version())
+    except Exception:
+        counter = None
+    write_rows(get_backend(), get_google_sheet(site), rows, row_updates, counter)
+    patch_cached_rows(site, rows, row_updates)
+    return row_updates
+
+def write_updates(row_updates, site):
+    # Returns True when the updates were queued for the sync worker instead of written to Sheets now
+    queue, worker = get_write_queue()
+    
+    if MIRRORED:
+        queue.update(site, row_updates)
+        if worker is not None:
+            worker.notify()
+        return False
+    
+    try:
+        # Never overtake writes already waiting for this site, or an older value could land last
+        if queue.has_pending(site):
+            raise PendingWritesError(site)
+        with_backoff(lambda: update_rows(row_updates, site))
+        return False
+    except Exception as e:
+        if not is_retryable(e):
+            raise
+        queue.queue_update(site, row_updates)
+        worker.notify()
+        return True
+
+def update_problems(row_updates, site):
+    try:
+        with metrics.timed("write", "update_problems"):
+            return write_updates(row_updates, site)
+    except Exception as e:
+        st.error(f"❌ Error updating problems: {str(e)}")
+        raise e
+
+def update_problem(problem_id, updates, site):
+    try:
+        with metrics.timed("write", "update_problem"):
+            return write_updates({problem_id: updates}, site)
     except Exception as e:
         st.error(f"❌ Error updating problem: {str(e)}")
         raise e
 
+def push_write(site, op, payload, retried=False):
+    apply_write(op, payload,
+                append=lambda rows, retried: append_problem_rows(rows, site, retried),
+                update=lambda row_updates: update_rows(row_updates, site),
+                allocate=lambda count: allocate_submission_ids(site, count),
+                retried=retried)
+
+def pull_site(site):
+    if STORAGE_BACKEND == "shared":
+        # Only the sync service reads Sheets; it pulls requested sites within a second
+        get_write_queue()[0].request_site(site)
+        return
+    get_write_queue()[0].replace_site(site, load_snapshot(site)["df"])
+
+def get_site_mirror(site):
+    # The first read of a site fills the mirror synchronously; the sync worker keeps it fresh afterwards
+    mirror = get_write_queue()[0]
+    if not mirror.has_site(site):
+        pull_site(site)
+        if STORAGE_BACKEND == "shared" and not mirror.wait_for_site(site, SHARED_WAIT_SECONDS):
+            error = mirror.pull_error(site)
+            if error:
+                raise RuntimeError(f"The sync service could not load {site}: {error}")
+            raise TimeoutError(f"{site} has not been loaded by the sync service yet. Is sync_service.py running?")
+    return mirror
+
+@st.cache_resource
+def get_write_queue():
+    # In sqlite mode the mirror doubles as the outbox; otherwise the outbox only holds writes Sheets refused.
+    # In shared mode the sync service owns the outbox and its worker, so this process starts none.
+    if STORAGE_BACKEND == "shared":
+        return SQLiteMirror(SQLITE_PATH, owner=False), None
+    if STORAGE_BACKEND == "sqlite":
+        queue = SQLiteMirror(SQLITE_PATH)
+        worker = SyncWorker(queue, push=push_write, pull=pull_site, pull_interval=DATA_TTL_SECONDS)
+    else:
+        queue = WriteQueue(SQLITE_PATH)
+        worker = SyncWorker(queue, push=push_write)
+    # st.cache_resource only serves threads that carry a script context
+    add_script_run_ctx(worker)
+    worker.start()
+    return queue, worker
+
+def archive_title(site, month):
+    return f"{site} Archive {month}"
+
+def archive_site(site, older_than_days=None):
+    # Moves RESOLVED rows resolved more than older_than_days ago into one worksheet per month of
+    # Date_Resolved, then deletes them from the live worksheet. Rows already in an archive are not
+    # copied again, so an interrupted run can simply be repeated. Returns the number of rows moved.
+    older_than_days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    if STORAGE_BACKEND == "shared":
+        raise RuntimeError("Archiving writes to Google Sheets directly and is not available in shared mode")
+    if get_write_queue()[0].has_pending(site):
+        raise PendingWritesError(site)
+    # Seed the ID counter while the highest IDs are still in the live worksheet
+    get_counter_row(site)
+    
+    with get_site_lock(site):
+        all_values = fetch_site_values(site)
+        df = build_dataframe(all_values)
+        cutoff = pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=older_than_days)
+        old = df[(df['Status'] == '🟢 RESOLVED') & (df['Date_Resolved'] < cutoff) & (df['Submission_ID'] > 0)]
+        if old.empty:
+            return 0
+        months = old['Date_Resolved'].dt.strftime("%Y-%m").unique()
+        
+        for month, rows in old.groupby(old['Date_Resolved'].dt.strftime("%Y-%m")):
+            archive = get_backend().open_worksheet(archive_title(site, month), HEADERS)
+            archived_ids = set(archive.col_values(1)[1:])
+            values = [all_values[index + 1] for index, problem_id in zip(rows.index, rows['Submission_ID'])
+                      if str(problem_id) not in archived_ids]
+            for start in range(0, len(values), APPEND_CHUNK_ROWS):
+                append_with_backoff(lambda retried: append_rows(archive, values[start:start + APPEND_CHUNK_ROWS],
+                                                                retried))
+        
+        # Every row is archived by now; if the live rows moved since they were read, a rerun finishes the job
+        sheet = get_google_sheet(site)
+        spans = row_spans((old.index + 2).tolist(), max_gap=0)
+        current_ids = sheet.batch_get([f"A{first}:A{last}" for first, last in spans])
+        for (first, last), values in zip(spans, current_ids):
+            if [row[0] if row else "" for row in values] != [all_values[row - 1][0] for row in range(first, last + 1)]:
+                raise ValueError("Rows moved while archiving; run the archive again")
+        # Sent once: if a delete that failed had landed, a retry would delete the rows that moved up into
+        # the spans. A rerun checks the rows again before deleting anything.
+        get_backend().delete_rows(sheet, spans)
+    
+    invalidate_data(site)
+    cache = get_data_cache()
+    cache["archive_titles"] = None
+    for month in months:
+        cache["archives"].pop(archive_title(site, month), None)
+        cache["search"].pop(archive_title(site, month), None)
+    bump_site_version(site)
+    if STORAGE_BACKEND == "sqlite":
+        pull_site(site)
+    return len(old)
+
+def archived_frames(site, start, end):
+    # {archive title: problems} for the months between start and end; only those archive worksheets are
+    # read. Shared-mode processes never read Sheets, and the sync service does not mirror archives.
+    if STORAGE_BACKEND == "shared":
+        return {}
+    cache = get_data_cache()
+    titles = cache["archive_titles"]
+    if titles is None or time.time() - titles[0] >= DATA_TTL_SECONDS:
+        titles = cache["archive_titles"] = (time.time(), set(get_backend().worksheet_titles()))
+    
+    frames = {}
+    for month in pd.period_range(start, end, freq='M').strftime("%Y-%m"):
+        title = archive_title(site, month)
+        if title not in titles[1]:
+            continue
+        if title not in cache["archives"]:
+            cache["archives"][title] = build_dataframe(get_backend().open_worksheet(title, HEADERS).get_all_values())
+        frames[title] = cache["archives"][title]
+    return frames
+
+def load_archived(site, start, end):
+    frames = list(archived_frames(site, start, end).values())
+    return apply_schema(pd.concat(frames, ignore_index=True)) if frames else build_dataframe([HEADERS])
+
+def search_archived(site, query, start, end):
+    # Each archive worksheet gets its own index, kept until an archive run adds to that month
+    cache = get_data_cache()
+    scores = {}
+    for title, df in archived_frames(site, start, end).items():
+        with cache["lock"]:
+            index = cache["search"].setdefault(title, SearchIndex())
+        with metrics.timed("dataframe", "search_index"):
+            index.sync(df)
+        scores.update(index.search(query))
+    return scores
+
+def sheet_frame(df):
+    # A copy of a snapshot frame with every value as the worksheet shows it
+    out = df.astype(object)
+    out = out.where(out.notna(), "")
+    for column in DATE_COLUMNS:
+        if column in df.columns and pd.api.types.is_datetime64_any_dtype(df[column]):
+            out[column] = df[column].dt.strftime(DATE_FORMAT).fillna("")
+    return out.astype(str)
+
+def export_frame(df, file_format):
+    out = sheet_frame(df)
+    if file_format == "CSV":
+        return out.to_csv(index=False).encode("utf-8-sig")
+    buffer = io.BytesIO()
+    out.to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+def show_export(df, file_name, key):
+    # The file is only built once a format is picked, so reruns do not pay for it
+    file_format = st.selectbox("📤 Export this view", ["—", "CSV", "Excel"], key=key)
+    if file_format != "—":
+        extension = "csv" if file_format == "CSV" else "xlsx"
+        st.download_button(f"⬇️ Download {file_format}", export_frame(df, file_format),
+                           file_name=f"{file_name}_{datetime.now().strftime('%Y%m%d')}.{extension}",
+                           mime="text/csv" if file_format == "CSV" else
+                                "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                           key=f"{key}_download")
+
+def read_import_file(uploaded_file):
+    uploaded_file.seek(0)
+    if uploaded_file.name.lower().endswith((".xlsx", ".xls")):
+        df = pd.read_excel(uploaded_file, dtype=str)
+    else:
+        df = pd.read_csv(uploaded_file, dtype=str, keep_default_na=False)
+    df.columns = [str(column).strip() for column in df.columns]
+    return df.fillna("").apply(lambda column: column.str.strip())
+
+def parse_import_dates(values):
+    # DD/MM/YYYY like the submit form; Excel cells come through as ISO timestamps
+    parsed = pd.to_datetime(values, format=DATE_FORMAT, errors='coerce')
+    return parsed.fillna(pd.to_datetime(values.where(parsed.isna()), format="ISO8601", errors='coerce'))
+
+def validate_import(df):
+    # Returns (rows, errors): rows in sheet order with a blank Submission_ID, and a frame of problems
+    # found, one row per file line. A Submission_ID column in the file is ignored; new IDs are allocated.
+    missing = [column for column in HEADERS[1:] if column not in df.columns]
+    if missing:
+        return None, pd.DataFrame({"Line": [1], "Problem": [f"Missing columns: {', '.join(missing)}"]})
+    
+    rows = df.reindex(columns=HEADERS, fill_value="")
+    rows['Submission_ID'] = ""
+    checks = [(rows['Task'] == "", "Task is empty"),
+              (~rows['Line_Number'].isin(LINES), "Unknown Line_Number"),
+              (~rows['Priority'].isin(PRIORITIES), "Unknown Priority"),
+              (~rows['Status'].isin(STATUSES), "Unknown Status")]
+    for column in DATE_COLUMNS:
+        parsed = parse_import_dates(rows[column])
+        required = rows['Status'] == '🟢 RESOLVED' if column == 'Date_Resolved' else True
+        checks.append((parsed.isna() & ((rows[column] != "") | required), f"{column} is not a DD/MM/YYYY date"))
+        rows[column] = parsed.dt.strftime(DATE_FORMAT).fillna("")
+    for column in ['Spare_Parts_Data', 'Notes', 'Troubleshooting_Steps']:
+        rows[column] = rows[column].replace("", "N/A")
+    
+    # File line numbers count the header row
+    errors = pd.concat([pd.DataFrame({"Line": rows.index[mask] + 2, "Problem": message})
+                        for mask, message in checks], ignore_index=True).sort_values("Line", kind='stable')
+    return rows, errors
+
+def import_problems(rows, site):
+    # Returns (ids, queued). One bulk ID allocation, then multi-row appends of APPEND_CHUNK_ROWS rows
+    # each. Once the IDs are allocated nothing is lost: chunks Sheets does not take go to the outbox.
+    ids = allocate_submission_ids(site, len(rows))
+    values = rows.assign(Submission_ID=ids).values.tolist()
+    chunks = [values[start:start + APPEND_CHUNK_ROWS] for start in range(0, len(values), APPEND_CHUNK_ROWS)]
+    queue, worker = get_write_queue()
+    if STORAGE_BACKEND == "shared":
+        for chunk in chunks:
+            queue.append_rows(site, chunk)
+        return ids, True
+    sheet = get_google_sheet(site)
+    queued = False
+    for number, chunk in enumerate(chunks):
+        try:
+            append_with_backoff(lambda retried: append_rows(sheet, chunk, retried))
+        except Exception:
+            # Rejected chunks end up under the sidebar's rejected changes instead of being lost. The failed
+            # chunk may still have landed, so pushing it checks column A first.
+            for offset, rest in enumerate(chunks[number:]):
+                if MIRRORED:
+                    queue.append_rows(site, rest, attempts=int(offset == 0))
+                else:
+                    queue.queue_append_rows(site, rest, attempts=int(offset == 0))
+            worker.notify()
+            queued = True
+            break
+    invalidate_data(site)
+    if STORAGE_BACKEND == "sqlite":
+        pull_site(site)
+    return ids, queued
+
+def site_versions():
+    # {site: (last allocated ID, version)}. In shared mode the mirror's versions change whenever the sync
+    # service pulled changes or another process wrote, so no process but the sync service polls Sheets.
+    if STORAGE_BACKEND == "shared":
+        return {site: (0, version) for site, version in get_write_queue()[0].site_versions().items()}
+    counters = read_counters(get_counter_sheet().get_all_values())
+    get_data_cache()["counter_rows"].update({site: row for site, (row, _, _) in counters.items()})
+    return {site: (last_id, version) for site, (_, last_id, version) in counters.items()}
+
+def highest_loaded_id(site):
+    if STORAGE_BACKEND == "sqlite":
+        return get_write_queue()[0].highest_id(site)
+    entry = get_data_cache()["sites"].get(site)
+    return int(entry["df"]['Submission_ID'].max()) if entry is not None and len(entry["df"]) else 0
+
+def poll_site_versions():
+    # One read of the counter sheet gives every site's version. Only changed sites that are being
+    # viewed are synced, and a snapshot sync only fetches new and active rows.
+    versions = get_data_cache()["versions"]
+    changed = []
+    for site, (last_id, version) in site_versions().items():
+        version_changed = versions.observe(site, last_id, version)
+        if site not in versions.awaiting:
+            continue
+        if STORAGE_BACKEND == "shared":
+            versions.synced(site, None)
+            changed.append(site)
+            continue
+        
+        loaded_id = highest_loaded_id(site)
+        if STORAGE_BACKEND == "sqlite":
+            synced = get_write_queue()[0].has_site(site)
+            if synced:
+                pull_site(site)
+        else:
+            synced = site in get_data_cache()["sites"]
+            if synced:
+                load_snapshot(site, max_age=0)
+        if synced and (version_changed or highest_loaded_id(site) > loaded_id):
+            changed.append(site)
+        versions.synced(site, highest_loaded_id(site) if synced else None)
+    return changed
+
+@st.cache_resource
+def get_change_watcher():
+    watcher = ChangeWatcher(poll_site_versions, interval=LIVE_REFRESH_SECONDS)
+    add_script_run_ctx(watcher)
+    watcher.start()
+    return watcher
+
+def wait_for_changes(sites, status):
+    # Keeps this run alive until the watcher syncs a change to one of the sites, then reruns. Writing
+    # to the status placeholder every second lets Streamlit interrupt the wait when the user interacts.
+    watcher = get_change_watcher()
+    seen = watcher.generation(sites)
+    while not watcher.wait(sites, seen, timeout=1):
+        if watcher.last_error:
+            status.caption(f"📡 Live updates paused: {watcher.last_error}")
+        else:
+            status.caption(f"📡 Live - checking for changes every {LIVE_REFRESH_SECONDS}s")
+    st.rerun()
+
+@st.cache_resource
+def get_metrics_log():
+    log = metrics.MetricsLog(METRICS_LOG or None)
+    metrics.background_log = log
+    return log
+
+def show_metrics_panel(run):
+    with st.sidebar.expander("⏱️ Performance"):
+        st.caption(f"This run: {run.elapsed() * 1000:.0f} ms")
+        summary = run.summary()
+        st.dataframe(summary.assign(Ms=(summary['Seconds'] * 1000).round(1)).drop(columns='Seconds'),
+                     use_container_width=True, hide_index=True)
+        st.caption("Recent runs (p50 / p95)")
+        st.dataframe(get_metrics_log().percentiles(), use_container_width=True, hide_index=True)
+
+run_metrics = metrics.start_run()
+get_metrics_log()
+
 if 'spare_parts' not in st.session_state:
     st.session_state.spare_parts = []
 if 'troubleshooting_steps' not in st.session_state:
@@ -260,66 +1205,151 @@ st.sidebar.markdown("---")
 selected_site = st.sidebar.selectbox("🏢 Select Site", SITES, key="site_selector")
 st.sidebar.markdown(f"**Current Site:** {selected_site}")
 
+pending_writes = get_write_queue()[0].pending_count()
+if pending_writes:
+    st.sidebar.warning(f"⏳ {pending_writes} change(s) waiting to sync with Google Sheets")
+
+if MIRRORED:
+    pull_error = get_write_queue()[0].pull_error(selected_site)
+    if pull_error:
+        st.sidebar.warning(f"⚠️ {selected_site} could not be refreshed from Google Sheets: {pull_error}")
+
+failed_writes = get_write_queue()[0].failed_writes()
+if failed_writes:
+    st.sidebar.error(f"❌ {len(failed_writes)} change(s) were rejected by Google Sheets")
+    with st.sidebar.expander("Rejected changes"):
+        for write_id, write_site, op, payload, error in failed_writes:
+            st.caption(f"{write_site} - {op} - {error}")
+            st.code(payload, language="json")
+            col1, col2 = st.columns(2)
+            if col1.button("🔁 Retry", key=f"retry_write_{write_id}"):
+                get_write_queue()[0].retry_failed(write_id)
+                st.rerun()
+            if col2.button("🗑️ Discard", key=f"discard_write_{write_id}"):
+                get_write_queue()[0].complete(write_id)
+                st.rerun()
+
 st.sidebar.markdown("---")
 if st.sidebar.button("🔄 REFRESH DATA"):
-    st.cache_resource.clear()
+    invalidate_data(selected_site)
+    if MIRRORED:
+        try:
+            pull_site(selected_site)
+        except Exception as e:
+            st.sidebar.error(f"❌ Error refreshing data: {str(e)}")
     st.rerun()
 
 page = st.sidebar.radio("Navigation", 
                         ["📊 Dashboard", 
+                         "🌐 All Sites", 
                          "➕ Submit New Problem", 
                          "✅ Update Problem Status",
-                         "📜 History"])
+                         "📜 History",
+                         "🔧 Parts Demand",
+                         "📈 Analytics",
+                         "📥 Import Problems"])
 
 st.sidebar.markdown("---")
+live_updates = st.sidebar.toggle("📡 Live updates", key="live_updates",
+                                 help="Keep the dashboards current without pressing REFRESH DATA")
+live_status = st.sidebar.empty()
+
+run_metrics.page, run_metrics.site = page, selected_site
+page_started = time.perf_counter()
+page_memory = metrics.memory_mark()
 
 if page == "📊 Dashboard":
     st.title(f"📊 DASHBOARD - {selected_site.upper()}")
     st.markdown("---")
     
-    df = load_data(selected_site)
+    summary = load_summary(selected_site)
+    active_summary = summary[summary.index.get_level_values('Status').isin(ACTIVE_STATUSES)]
     
-    if df.empty:
+    if summary.sum() == 0:
         st.warning("No problems recorded yet. Submit your first problem!")
+    elif active_summary.sum() == 0:
+        st.success("🎉 All problems resolved! No active issues.")
     else:
-        active_df = df[df['Status'].isin(['🔴 OPEN', '🟡 IN PROGRESS'])]
+        st.subheader("📈 SUMMARY BY LINE")
+        cols = st.columns(len(LINES))
+        line_counts = active_summary.groupby(level='Line_Number', observed=True).sum()
         
-        if active_df.empty:
-            st.success("🎉 All problems resolved! No active issues.")
+        for idx, line in enumerate(LINES):
+            with cols[idx]:
+                st.metric(label=line, value=int(line_counts.get(line, 0)))
+        
+        st.markdown("---")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            filter_line = st.selectbox("Filter by Line", ["All"] + LINES)
+        with col2:
+            filter_priority = st.selectbox("Filter by Priority", ["All"] + PRIORITIES)
+        with col3:
+            filter_status = st.selectbox("Filter by Status", ["All", "🔴 OPEN", "🟡 IN PROGRESS"])
+        
+        filtered_df = query_problems(selected_site,
+                                     Status=filter_status if filter_status != "All" else ACTIVE_STATUSES,
+                                     Line_Number=filter_line,
+                                     Priority=filter_priority)
+        
+        st.markdown("---")
+        st.subheader(f"🔧 ACTIVE PROBLEMS ({len(filtered_df)})")
+        
+        if filtered_df.empty:
+            st.info("No problems match your filters.")
         else:
-            st.subheader("📈 SUMMARY BY LINE")
-            cols = st.columns(len(LINES))
-            
-            for idx, line in enumerate(LINES):
-                line_count = len(active_df[active_df['Line_Number'] == line])
-                with cols[idx]:
-                    st.metric(label=line, value=line_count)
-            
-            st.markdown("---")
-            
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                filter_line = st.selectbox("Filter by Line", ["All"] + LINES)
-            with col2:
-                filter_priority = st.selectbox("Filter by Priority", ["All"] + PRIORITIES)
-            with col3:
-                filter_status = st.selectbox("Filter by Status", ["All", "🔴 OPEN", "🟡 IN PROGRESS"])
-            
-            filtered_df = active_df.copy()
-            if filter_line != "All":
-                filtered_df = filtered_df[filtered_df['Line_Number'] == filter_line]
-            if filter_priority != "All":
-                filtered_df = filtered_df[filtered_df['Priority'] == filter_priority]
-            if filter_status != "All":
-                filtered_df = filtered_df[filtered_df['Status'] == filter_status]
-            
-            st.markdown("---")
-            st.subheader(f"🔧 ACTIVE PROBLEMS ({len(filtered_df)})")
-            
-            if filtered_df.empty:
-                st.info("No problems match your filters.")
-            else:
-                st.dataframe(filtered_df, use_container_width=True, hide_index=True)
+            st.dataframe(filtered_df, use_container_width=True, hide_index=True, column_config=DATE_COLUMN_CONFIG)
+            show_export(filtered_df, f"{selected_site}_active_problems", key="dashboard_export")
+
+elif page == "🌐 All Sites":
+    st.title("🌐 DASHBOARD - ALL SITES")
+    st.markdown("---")
+    
+    started = time.time()
+    frames, errors = load_all_sites(SITES)
+    for site, error in errors.items():
+        st.error(f"❌ Error loading {site}: {str(error)}")
+    
+    all_df = pd.concat([df.assign(Site=site) for site, df in frames.items() if not df.empty] or
+                       [pd.DataFrame(columns=HEADERS + ['Site'])], ignore_index=True)
+    active_df = filter_problems(all_df, Status=ACTIVE_STATUSES)
+    st.caption(f"Loaded {len(frames)} of {len(SITES)} sites in {time.time() - started:.1f}s")
+    
+    if active_df.empty:
+        st.success("🎉 All problems resolved at every site! No active issues.")
+    else:
+        st.subheader("📈 ACTIVE PROBLEMS BY SITE")
+        site_counts = active_df['Site'].value_counts()
+        cols = st.columns(len(SITES))
+        for idx, site in enumerate(SITES):
+            with cols[idx]:
+                st.metric(label=site, value=int(site_counts.get(site, 0)) if site in frames else "—")
+        
+        st.markdown("---")
+        lines = LINES + sorted(set(active_df['Line_Number']) - set(LINES))
+        priorities = PRIORITIES + sorted(set(active_df['Priority']) - set(PRIORITIES))
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            st.subheader("🏭 BY SITE AND LINE")
+            st.dataframe(pd.crosstab(active_df['Site'], active_df['Line_Number'])
+                           .reindex(index=SITES, columns=lines, fill_value=0),
+                         use_container_width=True)
+        with col2:
+            st.subheader("⚠️ BY SITE AND PRIORITY")
+            st.dataframe(pd.crosstab(active_df['Site'], active_df['Priority'])
+                           .reindex(index=SITES, columns=priorities, fill_value=0),
+                         use_container_width=True)
+        
+        critical_df = active_df[active_df['Priority'] == 'CRITICAL']
+        st.markdown("---")
+        st.subheader(f"🚨 ACTIVE CRITICAL PROBLEMS ({len(critical_df)})")
+        if critical_df.empty:
+            st.info("No active CRITICAL problems.")
+        else:
+            st.dataframe(critical_df[['Site'] + HEADERS], use_container_width=True, hide_index=True,
+                         column_config=DATE_COLUMN_CONFIG)
 
 elif page == "➕ Submit New Problem":
     st.title(f"➕ SUBMIT NEW PROBLEM - {selected_site.upper()}")
@@ -392,11 +1422,8 @@ elif page == "➕ Submit New Problem":
             if not line_number or not date_submitted or not task or not submitted_by or not expected_due_date:
                 st.error("⚠️ Please fill in all required fields (*)")
             else:
-                df = load_data(selected_site)
-                submission_id = len(df) + 1 if not df.empty else 1
-                
-                date_submitted_str = date_submitted.strftime("%d/%m/%Y")
-                expected_due_date_str = expected_due_date.strftime("%d/%m/%Y")
+                date_submitted_str = date_submitted.strftime(DATE_FORMAT)
+                expected_due_date_str = expected_due_date.strftime(DATE_FORMAT)
                 
                 spare_parts_str = " | ".join([
                     f"{p['number']}:{p['name']}:Qty{p['quantity']}:Stock-{p['stock']}" 
@@ -406,7 +1433,7 @@ elif page == "➕ Submit New Problem":
                 ts_str = " | ".join(st.session_state.troubleshooting_steps) if st.session_state.troubleshooting_steps else "N/A"
                 
                 new_problem = [
-                    submission_id,
+                    "",
                     line_number,
                     date_submitted_str,
                     task,
@@ -422,9 +1449,13 @@ elif page == "➕ Submit New Problem":
                     ""
                 ]
                 
-                save_problem(new_problem, selected_site)
-                st.success(f"✅ Problem #{submission_id} submitted successfully!")
-                show_floating_logos()
+                submission_id, queued = save_problem(new_problem, selected_site)
+                if queued:
+                    st.warning(f"⏳ Google Sheets is busy. Problem {f'#{submission_id} ' if submission_id else ''}"
+                               f"was saved locally and will be submitted automatically.")
+                else:
+                    st.success(f"✅ Problem #{submission_id} submitted successfully!")
+                    show_floating_logos()
                 
                 st.session_state.spare_parts = []
                 st.session_state.troubleshooting_steps = []
@@ -433,27 +1464,106 @@ elif page == "✅ Update Problem Status":
     st.title(f"✅ UPDATE PROBLEM STATUS - {selected_site.upper()}")
     st.markdown("---")
     
+    # Set by the last update before its rerun, so the result stays on screen
+    update_notice = st.session_state.pop("update_notice", None)
+    if update_notice is not None:
+        queued, message = update_notice
+        if queued:
+            st.warning(message)
+        else:
+            st.success(message)
+            show_floating_logos()
+    
+    update_mode = st.radio("Update Mode", ["Single Problem", "📦 Bulk Update"], horizontal=True)
+    
     df = load_data(selected_site)
     
     if df.empty:
         st.warning("No problems recorded yet.")
     else:
-        active_df = df[df['Status'] != '🟢 RESOLVED']
+        active_df = load_problem_lookup(selected_site)
         
         if active_df.empty:
             st.success("🎉 All problems are resolved!")
+        elif update_mode == "📦 Bulk Update":
+            st.subheader("Select Problems to Update")
+            
+            selected_ids = st.multiselect("Choose Problems", active_df.index.tolist(), format_func=active_df['Label'].get)
+            selected_df = active_df[active_df.index.isin(selected_ids)]
+            
+            if not selected_df.empty:
+                st.dataframe(selected_df[['Submission_ID', 'Line_Number', 'Priority', 'Status', 'Task', 'Assigned_Engineer']],
+                             use_container_width=True, hide_index=True)
+            
+            st.markdown("---")
+            st.subheader(f"🔄 Update {len(selected_df)} Selected Problems")
+            
+            with st.form("bulk_update_form"):
+                new_status = st.selectbox("New Status", STATUSES, key="bulk_status")
+                assigned_engineer = st.text_input("Assigned Engineer Name (leave empty to keep each problem's current engineer)",
+                                                  key="bulk_engineer")
+                date_resolved = st.date_input("Date Resolved (resolved problems only)", value=datetime.now(), key="bulk_date_resolved")
+                resolution_notes = st.text_area("Resolution Notes (resolved problems only)", placeholder="How was it fixed?",
+                                                key="bulk_resolution_notes")
+                
+                bulk_button = st.form_submit_button("💾 UPDATE SELECTED", use_container_width=True)
+                
+                if bulk_button:
+                    missing_engineer = selected_df[selected_df['Assigned_Engineer'] == ""]['Submission_ID'].tolist()
+                    
+                    if selected_df.empty:
+                        st.error("⚠️ Select at least one problem to update!")
+                    elif not assigned_engineer and missing_engineer:
+                        st.error(f"⚠️ Assigned engineer name is required for: {', '.join(f'#{i}' for i in missing_engineer)}")
+                    elif new_status == "🟢 RESOLVED" and (not date_resolved or not resolution_notes):
+                        st.error("⚠️ Please fill in resolution date and notes for resolved problems!")
+                    else:
+                        resolved = new_status == "🟢 RESOLVED"
+                        date_resolved_str = date_resolved.strftime(DATE_FORMAT) if resolved else ""
+                        
+                        row_updates = {
+                            problem_id: {
+                                8: new_status,
+                                12: assigned_engineer if assigned_engineer else current_engineer,
+                                13: date_resolved_str,
+                                14: resolution_notes if resolved else ""
+                            }
+                            for problem_id, current_engineer in zip(selected_df['Submission_ID'], selected_df['Assigned_Engineer'])
+                        }
+                        
+                        if update_problems(row_updates, selected_site):
+                            st.session_state.update_notice = (True, f"⏳ Google Sheets is busy. The {len(row_updates)} updates "
+                                                                    f"were saved locally and will be written automatically.")
+                        else:
+                            st.session_state.update_notice = (False, f"✅ {len(row_updates)} problems updated successfully!")
+                        st.rerun()
         else:
             st.subheader("Select Problem to Update")
             
-            problem_options = [f"ID #{row['Submission_ID']} - {row['Line_Number']} - {row['Task'][:50]}..." 
-                             for _, row in active_df.iterrows()]
+            col1, col2, col3 = st.columns([1, 1, 2])
+            with col1:
+                picker_line = st.selectbox("Line", ["All"] + LINES, key="picker_line")
+            with col2:
+                picker_priority = st.selectbox("Priority", ["All"] + PRIORITIES, key="picker_priority")
+            with col3:
+                picker_text = st.text_input("🔎 Find problem", placeholder="ID, task, notes or part number",
+                                            key="picker_search").strip()
             
-            selected_problem = st.selectbox("Choose Problem", problem_options)
+            matches, match_count = pick_problems(selected_site, active_df, picker_text,
+                                                 Line_Number=picker_line, Priority=picker_priority)
+            if match_count > len(matches):
+                st.caption(f"Showing the top {len(matches)} of {match_count} matching problems - "
+                           f"type or filter to narrow down")
+            elif matches.empty:
+                st.info("No active problems match your search.")
+            
+            # Labels carry the ID, so they are unique; the shown matches map each label back to its ID
+            match_ids = dict(zip(matches['Label'], matches.index))
+            selected_problem = st.selectbox("Choose Problem", list(match_ids))
             
             if selected_problem:
-                problem_id = int(selected_problem.split("#")[1].split(" -")[0])
-                problem_row = df[df['Submission_ID'] == problem_id].iloc[0]
-                problem_index = df[df['Submission_ID'] == problem_id].index[0]
+                problem_id = match_ids[selected_problem]
+                problem_row = active_df.loc[problem_id]
                 
                 st.markdown("---")
                 st.subheader("📋 Problem Details")
@@ -467,15 +1577,16 @@ elif page == "✅ Update Problem Status":
                     st.write(f"**Submitted By:** {problem_row['Submitted_By_Engineer']}")
                 
                 with col2:
-                    st.write(f"**Date Submitted:** {problem_row['Date_Submitted']}")
-                    st.write(f"**Expected Due Date:** {problem_row['Expected_Due_Date']}")
+                    st.write(f"**Date Submitted:** {format_date(problem_row['Date_Submitted'])}")
+                    st.write(f"**Expected Due Date:** {format_date(problem_row['Expected_Due_Date'])}")
                     st.write(f"**Notes:** {problem_row['Notes']}")
                 
-                if problem_row['Spare_Parts_Data'] != "N/A":
+                problem_parts = load_spare_parts(selected_site)
+                problem_parts = problem_parts[problem_parts['Submission_ID'] == problem_id]
+                if not problem_parts.empty:
                     st.markdown("**Spare Parts:**")
-                    parts = problem_row['Spare_Parts_Data'].split(" | ")
-                    for part in parts:
-                        st.text(f"  • {part.replace(':', ' - ')}")
+                    for _, part in problem_parts.iterrows():
+                        st.text(f"  • {format_part(part)}")
                 
                 if problem_row['Troubleshooting_Steps'] != "N/A":
                     st.markdown("**Troubleshooting Steps Already Taken:**")
@@ -506,7 +1617,7 @@ elif page == "✅ Update Problem Status":
                         elif new_status == "🟢 RESOLVED" and (not date_resolved or not resolution_notes):
                             st.error("⚠️ Please fill in resolution date and notes for resolved problems!")
                         else:
-                            date_resolved_str = date_resolved.strftime("%d/%m/%Y") if new_status == "🟢 RESOLVED" else ""
+                            date_resolved_str = date_resolved.strftime(DATE_FORMAT) if new_status == "🟢 RESOLVED" else ""
                             
                             updates = {
                                 8: new_status,
@@ -515,100 +1626,323 @@ elif page == "✅ Update Problem Status":
                                 14: resolution_notes if new_status == "🟢 RESOLVED" else ""
                             }
                             
-                            update_problem(problem_index, updates, selected_site)
-                            st.success(f"✅ Problem #{problem_id} updated successfully!")
-                            show_floating_logos()
+                            if update_problem(problem_id, updates, selected_site):
+                                st.session_state.update_notice = (True, f"⏳ Google Sheets is busy. The update of problem "
+                                                                        f"#{problem_id} was saved locally and will be "
+                                                                        f"written automatically.")
+                            else:
+                                st.session_state.update_notice = (False, f"✅ Problem #{problem_id} updated successfully!")
                             st.rerun()
 
 elif page == "📜 History":
     st.title(f"📜 RESOLVED PROBLEMS HISTORY - {selected_site.upper()}")
     st.markdown("---")
     
-    df = load_data(selected_site)
+    resolved_df = query_problems(selected_site, Status='🟢 RESOLVED')
     
-    if df.empty:
+    if resolved_df.empty and load_data(selected_site).empty:
         st.warning("No problems recorded yet.")
     else:
-        resolved_df = df[df['Status'] == '🟢 RESOLVED']
+        st.subheader(f"📊 Total Resolved: {len(resolved_df)}")
         
-        if resolved_df.empty:
-            st.info("No resolved problems yet.")
+        col1, col2 = st.columns([2, 1])
+        with col1:
+            search_query = st.text_input("🔎 Search past problems",
+                                         placeholder="Task, notes, troubleshooting steps, resolution or part number",
+                                         help="Archived problems are only searched when a 'Resolved between' "
+                                              "range is picked",
+                                         key="hist_search").strip()
+        with col2:
+            resolved_range = st.date_input("Resolved between", value=(), format="DD/MM/YYYY", key="hist_resolved_range",
+                                           help=f"Problems resolved more than {ARCHIVE_AFTER_DAYS} days ago are read "
+                                                f"from the monthly archives for this range")
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            filter_line_hist = st.selectbox("Filter by Line", ["All"] + LINES, key="hist_line")
+        with col2:
+            filter_engineer = st.selectbox("Filter by Assigned Engineer", 
+                                          ["All"] + list(resolved_df['Assigned_Engineer'].unique()))
+        with col3:
+            filter_priority_hist = st.selectbox("Filter by Priority", ["All"] + PRIORITIES, key="hist_priority")
+        
+        filtered_resolved = query_problems(selected_site,
+                                           Status='🟢 RESOLVED',
+                                           Line_Number=filter_line_hist,
+                                           Assigned_Engineer=filter_engineer,
+                                           Priority=filter_priority_hist)
+        archived_scores = {}
+        if len(resolved_range) == 2:
+            start, end = pd.Timestamp(resolved_range[0]), pd.Timestamp(resolved_range[1])
+            try:
+                archived = filter_problems(load_archived(selected_site, start, end),
+                                           Line_Number=filter_line_hist,
+                                           Assigned_Engineer=filter_engineer,
+                                           Priority=filter_priority_hist)
+                if search_query:
+                    archived_scores = search_archived(selected_site, search_query, start, end)
+            except Exception as e:
+                st.error(f"❌ Error loading archives: {str(e)}")
+                archived = filtered_resolved.iloc[:0]
+            if not archived.empty:
+                filtered_resolved = apply_schema(pd.concat([filtered_resolved, archived], ignore_index=True)
+                                                   .drop_duplicates('Submission_ID'))
+            filtered_resolved = filtered_resolved[filtered_resolved['Date_Resolved'].between(start, end)]
+        search_scores = None
+        if search_query:
+            search_scores = {**archived_scores, **search_problems(selected_site, search_query)}
+            filtered_resolved = filtered_resolved[filtered_resolved['Submission_ID'].isin(search_scores)]
+        
+        st.markdown("---")
+        
+        if filtered_resolved.empty:
+            st.info("No resolved problems match your filters.")
         else:
-            st.subheader(f"📊 Total Resolved: {len(resolved_df)}")
-            
             col1, col2, col3 = st.columns(3)
             with col1:
-                filter_line_hist = st.selectbox("Filter by Line", ["All"] + LINES, key="hist_line")
+                sort_orders = ["Relevance"] + HISTORY_SORT_ORDERS if search_query else HISTORY_SORT_ORDERS
+                sort_order = st.selectbox("Sort by", sort_orders, key="hist_sort")
             with col2:
-                filter_engineer = st.selectbox("Filter by Assigned Engineer", 
-                                              ["All"] + list(resolved_df['Assigned_Engineer'].unique()))
+                page_size = st.selectbox("Problems per page", [10, 25, 50, 100], key="hist_page_size")
+            
+            total_pages = max(1, math.ceil(len(filtered_resolved) / page_size))
+            # The page lives in session state only: seeded once, and pulled back when the filters shrink the
+            # result. Passing value= as well would make Streamlit warn about the widget.
+            if "hist_page" not in st.session_state:
+                st.session_state.hist_page = 1
+            elif st.session_state.hist_page > total_pages:
+                st.session_state.hist_page = total_pages
             with col3:
-                filter_priority_hist = st.selectbox("Filter by Priority", ["All"] + PRIORITIES, key="hist_priority")
+                page_number = st.number_input("Page", min_value=1, max_value=total_pages, step=1, key="hist_page")
+            
+            # Only the visible page is sorted into expanders; everything else stays in the frame
+            start = (page_number - 1) * page_size
+            sorted_resolved = sort_problems(filtered_resolved, sort_order, search_scores)
+            page_df = sorted_resolved.iloc[start:start + page_size]
+            page_parts = load_spare_parts(selected_site)
+            page_parts = page_parts[page_parts['Submission_ID'].isin(page_df['Submission_ID'])]
+            st.caption(f"Showing {start + 1}-{start + len(page_df)} of {len(filtered_resolved)} resolved problems "
+                       f"(page {page_number} of {total_pages})")
+            show_export(sorted_resolved, f"{selected_site}_resolved_problems", key="history_export")
             
-            filtered_resolved = resolved_df.copy()
-            if filter_line_hist != "All":
-                filtered_resolved = filtered_resolved[filtered_resolved['Line_Number'] == filter_line_hist]
-            if filter_engineer != "All":
-                filtered_resolved = filtered_resolved[filtered_resolved['Assigned_Engineer'] == filter_engineer]
-            if filter_priority_hist != "All":
-                filtered_resolved = filtered_resolved[filtered_resolved['Priority'] == filter_priority_hist]
+            for idx, row in page_df.iterrows():
+                with st.expander(f"🆔 ID #{row['Submission_ID']} - {row['Line_Number']} - {row['Task'][:60]}... - Priority: {row['Priority']}"):
+                    col1, col2 = st.columns(2)
+                    
+                    with col1:
+                        st.markdown(f"**Line:** {row['Line_Number']}")
+                        st.markdown(f"**Task:** {row['Task']}")
+                        st.markdown(f"**Priority:** {row['Priority']}")
+                        st.markdown(f"**Submitted By:** {row['Submitted_By_Engineer']}")
+                        st.markdown(f"**Date Submitted:** {format_date(row['Date_Submitted'])}")
+                        st.markdown(f"**Expected Due:** {format_date(row['Expected_Due_Date'])}")
+                    
+                    with col2:
+                        st.markdown(f"**Assigned Engineer:** {row['Assigned_Engineer']}")
+                        st.markdown(f"**Date Resolved:** {format_date(row['Date_Resolved'])}")
+                        st.markdown(f"**Status:** {row['Status']}")
+                        st.markdown(f"**Notes:** {row['Notes']}")
+                    
+                    st.markdown("---")
+                    
+                    row_parts = page_parts[page_parts['Submission_ID'] == row['Submission_ID']]
+                    if not row_parts.empty:
+                        st.markdown("**🔧 Spare Parts Used:**")
+                        for _, part in row_parts.iterrows():
+                            st.text(f"  • {format_part(part)}")
+                    
+                    if row['Troubleshooting_Steps'] != "N/A":
+                        st.markdown("**🔍 Troubleshooting Steps:**")
+                        steps = row['Troubleshooting_Steps'].split(" | ")
+                        for step_idx, step in enumerate(steps):
+                            st.text(f"  {step_idx+1}. {step}")
+                    
+                    st.markdown(f"**✅ Resolution Notes:** {row['Resolution_Notes']}")
             
             st.markdown("---")
+            st.subheader("📈 STATISTICS")
+            col1, col2, col3, col4 = st.columns(4)
+            
+            priority_counts = filtered_resolved['Priority'].value_counts()
+            engineer_counts = filtered_resolved['Assigned_Engineer'].value_counts()
+            
+            with col1:
+                total_resolved = len(filtered_resolved)
+                st.metric("Total Resolved", total_resolved)
+            
+            with col2:
+                critical_resolved = int(priority_counts.get('CRITICAL', 0))
+                st.metric("Critical Resolved", critical_resolved)
+            
+            with col3:
+                top_engineer = engineer_counts.idxmax() if not engineer_counts.empty else "N/A"
+                st.metric("Top Contributor", top_engineer)
             
-            if filtered_resolved.empty:
-                st.info("No resolved problems match your filters.")
+            with col4:
+                high_priority = int(priority_counts.get('High', 0))
+                st.metric("High Priority Resolved", high_priority)
+        
+        st.markdown("---")
+        with st.expander("🗄️ Archive old resolved problems"):
+            if STORAGE_BACKEND == "shared":
+                st.info("Archiving and archived months are not available in shared mode, where only the sync "
+                        "service talks to Google Sheets.")
             else:
-                for idx, row in filtered_resolved.iterrows():
-                    with st.expander(f"🆔 ID #{row['Submission_ID']} - {row['Line_Number']} - {row['Task'][:60]}... - Priority: {row['Priority']}"):
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            st.markdown(f"**Line:** {row['Line_Number']}")
-                            st.markdown(f"**Task:** {row['Task']}")
-                            st.markdown(f"**Priority:** {row['Priority']}")
-                            st.markdown(f"**Submitted By:** {row['Submitted_By_Engineer']}")
-                            st.markdown(f"**Date Submitted:** {row['Date_Submitted']}")
-                            st.markdown(f"**Expected Due:** {row['Expected_Due_Date']}")
-                        
-                        with col2:
-                            st.markdown(f"**Assigned Engineer:** {row['Assigned_Engineer']}")
-                            st.markdown(f"**Date Resolved:** {row['Date_Resolved']}")
-                            st.markdown(f"**Status:** {row['Status']}")
-                            st.markdown(f"**Notes:** {row['Notes']}")
-                        
-                        st.markdown("---")
-                        
-                        if row['Spare_Parts_Data'] != "N/A":
-                            st.markdown("**🔧 Spare Parts Used:**")
-                            parts = row['Spare_Parts_Data'].split(" | ")
-                            for part in parts:
-                                st.text(f"  • {part.replace(':', ' - ')}")
-                        
-                        if row['Troubleshooting_Steps'] != "N/A":
-                            st.markdown("**🔍 Troubleshooting Steps:**")
-                            steps = row['Troubleshooting_Steps'].split(" | ")
-                            for step_idx, step in enumerate(steps):
-                                st.text(f"  {step_idx+1}. {step}")
-                        
-                        st.markdown(f"**✅ Resolution Notes:** {row['Resolution_Notes']}")
-                
-                st.markdown("---")
-                st.subheader("📈 STATISTICS")
-                col1, col2, col3, col4 = st.columns(4)
-                
-                with col1:
-                    total_resolved = len(filtered_resolved)
-                    st.metric("Total Resolved", total_resolved)
-                
-                with col2:
-                    critical_resolved = len(filtered_resolved[filtered_resolved['Priority'] == 'CRITICAL'])
-                    st.metric("Critical Resolved", critical_resolved)
-                
-                with col3:
-                    top_engineer = filtered_resolved['Assigned_Engineer'].value_counts().idxmax() if not filtered_resolved.empty else "N/A"
-                    st.metric("Top Contributor", top_engineer)
+                archive_cutoff = pd.Timestamp(datetime.now().date()) - pd.Timedelta(days=ARCHIVE_AFTER_DAYS)
+                eligible = int((resolved_df['Date_Resolved'] < archive_cutoff).sum())
+                st.write(f"{eligible} problem(s) resolved before {format_date(archive_cutoff)} can be moved to monthly "
+                         f"archive worksheets. They can still be browsed here by picking a 'Resolved between' range.")
+                if st.button("🗄️ ARCHIVE NOW", disabled=eligible == 0, key="archive_now"):
+                    try:
+                        archived_count = archive_site(selected_site)
+                        st.success(f"✅ {archived_count} resolved problems archived!")
+                        st.rerun()
+                    except PendingWritesError:
+                        st.warning("⏳ Changes for this site are still waiting to sync. Try again once they are saved.")
+                    except Exception as e:
+                        st.error(f"❌ Error archiving problems: {str(e)}")
+
+
+elif page == "🔧 Parts Demand":
+    st.title(f"🔧 SPARE PARTS DEMAND - {selected_site.upper()}")
+    st.markdown("---")
+    
+    active_df = query_problems(selected_site, Status=ACTIVE_STATUSES)
+    
+    if active_df.empty:
+        st.info("No active problems, so no spare parts are needed right now.")
+    else:
+        filter_line_parts = st.selectbox("Filter by Line", ["All"] + LINES, key="parts_line")
+        active_df = filter_problems(active_df, Line_Number=filter_line_parts)
+        
+        parts = load_spare_parts(selected_site)
+        demand = parts_demand(parts, active_df)
+        blocking = blocking_parts(parts, active_df[active_df['Priority'] == 'CRITICAL'])
+        
+        col1, col2, col3, col4 = st.columns(4)
+        with col1:
+            st.metric("Part Numbers Needed", len(demand))
+        with col2:
+            st.metric("Total Quantity Needed", int(demand['Quantity'].sum()))
+        with col3:
+            st.metric("Quantity Out of Stock", int(demand['Out_Of_Stock'].sum()))
+        with col4:
+            st.metric("Parts Blocking CRITICAL", len(blocking))
+        
+        st.markdown("---")
+        st.subheader("⛔ OUT-OF-STOCK PARTS BLOCKING CRITICAL PROBLEMS")
+        if blocking.empty:
+            st.success("No open CRITICAL problem is waiting on an out-of-stock part.")
+        else:
+            st.dataframe(blocking, use_container_width=True, hide_index=True)
+        
+        st.markdown("---")
+        st.subheader("📦 QUANTITY NEEDED BY PART NUMBER")
+        if demand.empty:
+            st.info("No spare parts requested for these problems.")
+        else:
+            st.dataframe(demand, use_container_width=True, hide_index=True)
+
+elif page == "📈 Analytics":
+    st.title(f"📈 ANALYTICS - {selected_site.upper()}")
+    st.markdown("---")
+    
+    analytics = load_analytics(selected_site)
+    days = analytics["days"]
+    overdue = analytics["overdue"]
+    
+    col1, col2, col3, col4, col5 = st.columns(5)
+    with col1:
+        st.metric("Resolved (dated)", len(days))
+    with col2:
+        st.metric("Mean Days to Resolve", f"{days.mean():.1f}" if not days.empty else "N/A")
+    with col3:
+        st.metric("Median Days", f"{days.median():.1f}" if not days.empty else "N/A")
+    with col4:
+        st.metric("P90 Days", f"{days.quantile(0.9):.1f}" if not days.empty else "N/A")
+    with col5:
+        st.metric("Overdue Active", len(overdue))
+    
+    st.markdown("---")
+    st.subheader("⏱️ TIME TO RESOLVE")
+    dimension = st.radio("Group by", list(ANALYTICS_DIMENSIONS), horizontal=True, key="analytics_dimension")
+    stats = analytics["by"][dimension]
+    if stats.empty:
+        st.info("No resolved problems with submission and resolution dates yet.")
+    else:
+        col1, col2 = st.columns(2)
+        with col1:
+            st.dataframe(stats, use_container_width=True)
+        with col2:
+            st.bar_chart(stats[['Mean Days', 'P90 Days']])
+    
+    st.markdown("---")
+    st.subheader(f"⏰ OVERDUE ACTIVE PROBLEMS ({len(overdue)})")
+    if overdue.empty:
+        st.success("No active problem is past its expected due date.")
+    else:
+        st.dataframe(overdue[['Submission_ID', 'Days_Overdue', 'Line_Number', 'Priority', 'Status', 'Task',
+                              'Assigned_Engineer', 'Date_Submitted', 'Expected_Due_Date']],
+                     use_container_width=True, hide_index=True, column_config=DATE_COLUMN_CONFIG)
+    
+    st.markdown("---")
+    st.subheader("📅 WEEKLY TRENDS")
+    trends = analytics["trends"]
+    if trends.empty:
+        st.info("No dated problems yet.")
+    else:
+        st.line_chart(trends[["Submitted", "Resolved"]])
+        st.line_chart(trends[["Mean Days to Resolve"]])
+
+elif page == "📥 Import Problems":
+    st.title(f"📥 IMPORT PROBLEMS - {selected_site.upper()}")
+    st.markdown("---")
+    
+    st.markdown("Upload a CSV or Excel file with one problem per row and the same columns as the sheet. "
+                "Dates use DD/MM/YYYY, and new Submission IDs are allocated during the import.")
+    st.download_button("⬇️ Download CSV template", pd.DataFrame(columns=HEADERS).to_csv(index=False).encode("utf-8-sig"),
+                       file_name="problems_template.csv", mime="text/csv")
+    
+    uploaded_file = st.file_uploader("Problems file", type=["csv", "xlsx"], key="import_file")
+    
+    if uploaded_file is not None:
+        try:
+            import_rows, import_errors = validate_import(read_import_file(uploaded_file))
+        except Exception as e:
+            st.error(f"❌ Error reading file: {str(e)}")
+            import_rows, import_errors = None, None
+        
+        if import_errors is not None and not import_errors.empty:
+            st.error(f"⚠️ {import_errors['Line'].nunique()} line(s) need fixing before the file can be imported:")
+            st.dataframe(import_errors, use_container_width=True, hide_index=True)
+        elif import_rows is not None and import_rows.empty:
+            st.info("The file has no problems to import.")
+        elif import_rows is not None:
+            if st.session_state.get("imported_file") == uploaded_file.file_id:
+                st.info("✅ This file has already been imported.")
+            else:
+                st.success(f"✅ {len(import_rows)} problems are ready to import")
+                st.dataframe(import_rows.head(20), use_container_width=True, hide_index=True)
                 
-                with col4:
-                    high_priority = len(filtered_resolved[filtered_resolved['Priority'] == 'High'])
-                    st.metric("High Priority Resolved", high_priority)
-                    
+                if st.button(f"📥 IMPORT {len(import_rows)} PROBLEMS", use_container_width=True, key="import_button"):
+                    try:
+                        imported_ids, queued = import_problems(import_rows, selected_site)
+                        st.session_state.imported_file = uploaded_file.file_id
+                        if queued:
+                            st.warning(f"⚠️ Problems #{imported_ids[0]} to #{imported_ids[-1]} are saved and will be "
+                                       f"added to Google Sheets in the background.")
+                        else:
+                            st.success(f"✅ Imported problems #{imported_ids[0]} to #{imported_ids[-1]}!")
+                        show_floating_logos()
+                    except Exception as e:
+                        st.error(f"❌ Error importing problems: {str(e)}")
+                        raise e
+
+metrics.record("page", page, time.perf_counter() - page_started)
+run_metrics.page_peak_bytes = metrics.memory_peak(page_memory)
+get_metrics_log().write(run_metrics)
+if SHOW_METRICS:
+    show_metrics_panel(run_metrics)
+
+if live_updates and page in ("📊 Dashboard", "🌐 All Sites"):
+    wait_for_changes(SITES if page == "🌐 All Sites" else [selected_site], live_status)
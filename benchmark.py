@@ -0,0 +1,213 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import pandas as pd
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+from storage import DATE_FORMAT, HEADERS
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "App.py")
+
+SITE = "Faragallah"
+
+# Rough shape of a plant's sheet after a few years: most problems resolved, a long tail of
+# low-priority work and a few busy lines
+STATUS_WEIGHTS = {"🟢 RESOLVED": 0.80, "🔴 OPEN": 0.12, "🟡 IN PROGRESS": 0.08}
+PRIORITY_WEIGHTS = {"Low": 0.30, "Medium": 0.40, "High": 0.20, "CRITICAL": 0.10}
+LINE_WEIGHTS = {"Line 3": 0.25, "Line 7": 0.20, "Line 9": 0.20, "Line 10": 0.15, "Line 12": 0.12, "Line 13": 0.08}
+
+ENGINEERS = ["Ahmed Hassan", "Mohamed Ali", "Khaled Ibrahim", "Omar Mahmoud", "Youssef Ahmed"]
+
+MACHINES = ["Filler", "Capper", "Labeler", "Conveyor", "Palletizer", "Shrink wrapper", "Mixer", "Compressor"]
+FAULTS = ["motor overheating", "bearing noise", "belt slipping", "sensor not detecting", "air leak",
+          "jammed at infeed", "PLC alarm", "vibration", "oil leak", "drive fault"]
+PARTS = [(f"SP-{10001 + i}", name) for i, name in enumerate(
+    ["Bearing 6205", "V-Belt A42", "Proximity sensor", "Solenoid valve", "Contactor 24V", "Gear motor",
+     "Timing belt", "Air cylinder", "Photo eye", "Drive fuse", "Coupling", "Seal kit"])]
+STEPS = ["Checked power supply", "Reset the drive", "Cleaned the sensor", "Tightened the belt",
+         "Replaced fuse", "Checked air pressure", "Lubricated bearings", "Inspected wiring",
+         "Recalibrated sensor", "Called electrical team"]
+
+# (name, page, widget settings applied before the measured run, run on a freshly started app).
+# A cold run is the first run of a new session with empty caches, so it always shows the Dashboard.
+SCENARIOS = [
+    ("load_data (cold)", "📊 Dashboard", {}, True),
+    ("Dashboard", "📊 Dashboard", {}, False),
+    ("Dashboard filtered", "📊 Dashboard", {"Filter by Line": "Line 3", "Filter by Priority": "High"}, False),
+    ("Update options", "✅ Update Problem Status", {}, False),
+    ("History", "📜 History", {}, False),
+    ("History search", "📜 History", {"hist_search": "bearing"}, False),
+]
+
+DEFAULT_SIZES = [1_000, 10_000, 100_000]
+
+
+def weighted(rng, weights):
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
+
+
+def synthetic_row(rng, submission_id, today):
+    status = weighted(rng, STATUS_WEIGHTS)
+    submitted = today - timedelta(days=rng.randint(0, 3 * 365))
+    due = submitted + timedelta(days=rng.randint(1, 14))
+
+    if rng.random() < 0.45:
+        spare_parts = " | ".join(f"{number}:{name}:Qty{rng.randint(1, 4)}:Stock-{rng.choice(['Yes', 'No'])}"
+                                 for number, name in rng.sample(PARTS, rng.randint(1, 3)))
+    else:
+        spare_parts = "N/A"
+    steps = " | ".join(rng.sample(STEPS, rng.randint(1, 4))) if rng.random() < 0.8 else "N/A"
+
+    resolved = status == "🟢 RESOLVED"
+    date_resolved = min(submitted + timedelta(days=int(rng.expovariate(1 / 5))), today) if resolved else None
+    return [
+        str(submission_id),
+        weighted(rng, LINE_WEIGHTS),
+        submitted.strftime(DATE_FORMAT),
+        f"{rng.choice(MACHINES)} {rng.choice(FAULTS)}",
+        spare_parts,
+        weighted(rng, PRIORITY_WEIGHTS),
+        rng.choice(["N/A", "Happens on night shift", "Second time this month"]),
+        status,
+        rng.choice(ENGINEERS),
+        due.strftime(DATE_FORMAT),
+        steps,
+        rng.choice(ENGINEERS) if status != "🔴 OPEN" else "",
+        date_resolved.strftime(DATE_FORMAT) if resolved else "",
+        f"{rng.choice(['Replaced', 'Adjusted', 'Cleaned', 'Repaired'])} {rng.choice(PARTS)[1].lower()}" if resolved else "",
+    ]
+
+
+def synthetic_sheet(rows, seed=0):
+    rng = random.Random(seed)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    return [HEADERS] + [synthetic_row(rng, submission_id, today) for submission_id in range(1, rows + 1)]
+
+
+def write_seed(path, rows, seed=0):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({SITE: synthetic_sheet(rows, seed),
+                   "ID_Counters": [['Site', 'Last_Submission_ID', 'Version'], [SITE, str(rows), "benchmark"]]},
+                  f, ensure_ascii=False)
+
+
+def start_app(workdir, seed_path):
+    # Clears the process-wide caches, so the first run of the returned app loads the site from scratch
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    at.secrets["SHEETS_BACKEND"] = "memory"
+    at.secrets["MEMORY_SEED_PATH"] = seed_path
+    at.secrets["STORAGE_BACKEND"] = "sheets"
+    at.secrets["SQLITE_PATH"] = os.path.join(workdir, "benchmark.db")
+    at.secrets["METRICS_LOG"] = os.path.join(workdir, "metrics.jsonl")
+    return at
+
+
+def last_run(workdir):
+    with open(os.path.join(workdir, "metrics.jsonl"), encoding="utf-8") as f:
+        return json.loads(f.readlines()[-1])
+
+
+def select(at, page, widgets):
+    next(radio for radio in at.sidebar.radio if radio.label == "Navigation").set_value(page)
+    at.run()
+    for label, value in widgets.items():
+        matches = [w for w in at.selectbox if w.label == label] or [w for w in at.text_input if w.key == label]
+        matches[0].set_value(value)
+
+
+def measure(at, workdir, page, trace=False):
+    # Returns (wall seconds of the whole run, seconds spent in the page section, peak bytes the page
+    # section allocated). The app measures the peak itself, so the test harness re-compiling App.py
+    # on every run is left out.
+    if trace:
+        tracemalloc.start()
+    started = time.perf_counter()
+    at.run()
+    wall = time.perf_counter() - started
+    if trace:
+        tracemalloc.stop()
+
+    if len(at.exception):
+        raise RuntimeError(f"{page} failed: {at.exception[0].value}")
+    run = last_run(workdir)
+    return wall, run["timings"].get(f"page: {page}", {}).get("ms", 0.0) / 1000, run.get("page_peak_bytes")
+
+
+def run_size(rows, repeat, seed):
+    with tempfile.TemporaryDirectory() as workdir:
+        seed_path = os.path.join(workdir, "seed.json")
+        write_seed(seed_path, rows, seed)
+
+        at = None
+        results = []
+        for name, page, widgets, cold in SCENARIOS:
+            # Peak memory is taken on one extra run: tracing allocations slows everything down
+            samples = []
+            for trace in [False] * repeat + [True]:
+                if cold or at is None:
+                    at = start_app(workdir, seed_path)
+                    if not cold:
+                        at.run()
+                if not cold:
+                    select(at, page, widgets)
+                samples.append(measure(at, workdir, page, trace))
+
+            timed = samples[:-1] or samples
+            results.append({"Scenario": name, "Rows": rows,
+                            "Wall ms": statistics.median(wall for wall, _, _ in timed) * 1000,
+                            "Page ms": statistics.median(page_time for _, page_time, _ in timed) * 1000,
+                            "Peak MB": samples[-1][2] / 2 ** 20})
+            print(f"  {name:<20} {results[-1]['Page ms']:>10.1f} ms", file=sys.stderr)
+        return results
+
+
+def compare(results, baseline, tolerance):
+    # Scenarios whose page time grew by more than the tolerance against the saved baseline. The page
+    # section leaves out the test harness and the backend start-up, so it is the steadier number.
+    merged = results.merge(baseline, on=["Scenario", "Rows"], suffixes=("", " baseline"))
+    merged["Change"] = merged["Page ms"] / merged["Page ms baseline"] - 1
+    return merged[merged["Change"] > tolerance]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each page's data path against synthetic sites "
+                                                 "served by the in-memory Sheets backend")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per scenario (the median is reported)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--save", help="write the results to this CSV file")
+    parser.add_argument("--baseline", help="CSV from an earlier --save to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline before the run fails (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = []
+    for rows in args.rows:
+        print(f"{rows:,} rows", file=sys.stderr)
+        results += run_size(rows, args.repeat, args.seed)
+    results = pd.DataFrame(results).round(1)
+    print(results.to_string(index=False))
+
+    if args.save:
+        results.to_csv(args.save, index=False)
+    if args.baseline:
+        regressions = compare(results, pd.read_csv(args.baseline), args.tolerance)
+        if not regressions.empty:
+            print("\nSlower than the baseline:")
+            print(regressions[["Scenario", "Rows", "Page ms baseline", "Page ms", "Change"]].round(2).to_string(index=False))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+import pandas as pd
+
+_local = threading.local()
+
+# Timings recorded outside a script run (sync worker, change watcher) only feed the percentiles
+background_log = None
+
+
+class RunMetrics:
+    # Everything timed during one script run: [(category, name, seconds)]
+
+    def __init__(self, page=None, site=None):
+        self.page = page
+        self.site = site
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        # Peak bytes allocated by the page section; only measured while tracemalloc is tracing
+        self.page_peak_bytes = None
+
+    def record(self, category, name, seconds):
+        with self.lock:
+            self.events.append((category, name, seconds))
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        with self.lock:
+            events = pd.DataFrame(self.events, columns=['Category', 'Name', 'Seconds'])
+        summary = events.groupby(['Category', 'Name'], as_index=False).agg(Calls=('Seconds', 'size'),
+                                                                           Seconds=('Seconds', 'sum'))
+        return summary.sort_values('Seconds', ascending=False, ignore_index=True)
+
+
+class MetricsLog:
+    # Appends one JSON line per finished run to a size-rotated file and keeps a window of recent
+    # durations per timing for p50/p95
+
+    def __init__(self, path=None, max_bytes=5_000_000, backups=3, window=1000):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(lambda: deque(maxlen=window))
+        self.logger = None
+        if path:
+            self.logger = logging.getLogger(f"factory_tracker.metrics.{path}")
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            if not self.logger.handlers:
+                handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                self.logger.addHandler(handler)
+
+    def observe(self, key, seconds):
+        with self.lock:
+            self.samples[key].append(seconds)
+
+    def write(self, run):
+        total = run.elapsed()
+        summary = run.summary()
+        for category, name, seconds in list(run.events):
+            self.observe(f"{category}: {name}", seconds)
+        self.observe(f"run: {run.page}", total)
+
+        if self.logger is not None:
+            line = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "page": run.page,
+                "site": run.site,
+                "total_ms": round(total * 1000, 1),
+                "timings": {f"{row.Category}: {row.Name}": {"calls": int(row.Calls), "ms": round(row.Seconds * 1000, 1)}
+                            for row in summary.itertuples()}
+            }
+            if run.page_peak_bytes is not None:
+                line["page_peak_bytes"] = run.page_peak_bytes
+            self.logger.info(json.dumps(line, ensure_ascii=False))
+
+    def percentiles(self):
+        with self.lock:
+            samples = {key: list(values) for key, values in self.samples.items()}
+        rows = [(key, len(values), pd.Series(values).quantile(0.5) * 1000, pd.Series(values).quantile(0.95) * 1000)
+                for key, values in samples.items()]
+        return (pd.DataFrame(rows, columns=['Timing', 'Samples', 'p50 ms', 'p95 ms'])
+                  .sort_values('p95 ms', ascending=False, ignore_index=True)
+                  .round(1))
+
+
+def start_run(page=None, site=None):
+    run = RunMetrics(page, site)
+    _local.run = run
+    return run
+
+
+def attach(run):
+    # Helper threads started by a script run report into that run
+    _local.run = run
+
+
+def current_run():
+    return getattr(_local, "run", None)
+
+
+def record(category, name, seconds):
+    run = current_run()
+    if run is not None:
+        run.record(category, name, seconds)
+    elif background_log is not None:
+        background_log.observe(f"{category}: {name} (background)", seconds)
+
+
+def memory_mark():
+    # Starts a peak measurement when tracemalloc is tracing (the benchmark does); returns the current level
+    if not tracemalloc.is_tracing():
+        return None
+    tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def memory_peak(mark):
+    # Peak bytes allocated on top of the level at memory_mark()
+    if mark is None or not tracemalloc.is_tracing():
+        return None
+    return tracemalloc.get_traced_memory()[1] - mark
+
+
+@contextmanager
+def timed(category, name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(category, name, time.perf_counter() - started)
+
+
+class TimedWorksheet:
+    # Times every method call of a worksheet as one Sheets API call; attributes pass through
+
+    def __init__(self, sheet):
+        self._sheet = sheet
+
+    def __getattr__(self, name):
+        value = getattr(self._sheet, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with timed("sheets", f"{self._sheet.title}.{name}"):
+                return value(*args, **kwargs)
+        return call
+
+
+class TimedBackend:
+    # Times every backend call and hands out timed worksheets
+
+    def __init__(self, backend):
+        self._backend = backend
+
+    def open_worksheet(self, title, headers, rows=1000, cols=20):
+        with timed("sheets", f"open_worksheet {title}"):
+            return TimedWorksheet(self._backend.open_worksheet(title, headers, rows, cols))
+
+    def delete_rows(self, sheet, spans):
+        with timed("sheets", f"{sheet.title}.delete_rows"):
+            return self._backend.delete_rows(getattr(sheet, "_sheet", sheet), spans)
+
+    def __getattr__(self, name):
+        value = getattr(self._backend, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            with timed("sheets", name):
+                return value(*args, **kwargs)
+        return call
@@ -0,0 +1,113 @@
+import bisect
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+import pandas as pd
+
+SEARCH_COLUMNS = ['Task', 'Notes', 'Troubleshooting_Steps', 'Resolution_Notes', 'Spare_Parts_Data']
+
+# Words, numbers and hyphenated codes such as part numbers (SP-12345); Arabic letters are kept as words
+TOKEN_PATTERN = re.compile(r"[0-9a-z؀-ۿ]+(?:-[0-9a-z؀-ۿ]+)*")
+
+STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+              "n", "na", "of", "on", "or", "the", "to", "was", "were", "with"}
+
+# BM25 ranking parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    return [token for token in TOKEN_PATTERN.findall(str(text).lower()) if token not in STOP_WORDS]
+
+
+class SearchIndex:
+    # Inverted index over the free-text columns of one site, keyed by Submission_ID. sync() only
+    # re-tokenizes rows that are new or whose text changed since the last snapshot it saw.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = defaultdict(dict)
+        self.doc_tokens = {}
+        self.doc_lengths = {}
+        self.total_length = 0
+        self.fingerprints = pd.Series(dtype='uint64')
+        self.vocabulary = []
+        self.vocabulary_dirty = False
+        self.source = None
+
+    def sync(self, df):
+        with self.lock:
+            if df is self.source:
+                return
+
+            rows = df[~df['Submission_ID'].duplicated(keep='last')]
+            fingerprints = pd.util.hash_pandas_object(rows[SEARCH_COLUMNS], index=False)
+            fingerprints.index = rows['Submission_ID'].to_numpy()
+
+            known = self.fingerprints.reindex(fingerprints.index)
+            changed = fingerprints.index[fingerprints.ne(known)]
+            for doc_id in self.fingerprints.index.difference(fingerprints.index).union(changed):
+                self.remove(doc_id)
+
+            changed_rows = rows[rows['Submission_ID'].isin(changed)]
+            texts = changed_rows[SEARCH_COLUMNS].astype(str).agg(" ".join, axis=1) if not changed_rows.empty else []
+            for doc_id, text in zip(changed_rows['Submission_ID'], texts):
+                self.add(doc_id, text)
+
+            self.fingerprints = fingerprints
+            self.source = df
+
+    def add(self, doc_id, text):
+        counts = Counter(tokenize(text))
+        for token, count in counts.items():
+            if token not in self.postings:
+                self.vocabulary_dirty = True
+            self.postings[token][doc_id] = count
+        self.doc_tokens[doc_id] = list(counts)
+        self.doc_lengths[doc_id] = sum(counts.values())
+        self.total_length += self.doc_lengths[doc_id]
+
+    def remove(self, doc_id):
+        for token in self.doc_tokens.pop(doc_id, []):
+            postings = self.postings[token]
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[token]
+                self.vocabulary_dirty = True
+        self.total_length -= self.doc_lengths.pop(doc_id, 0)
+
+    def expand(self, term):
+        # The last word of a query also matches as a prefix, so results show up while typing
+        if self.vocabulary_dirty:
+            self.vocabulary = sorted(self.postings)
+            self.vocabulary_dirty = False
+        start = bisect.bisect_left(self.vocabulary, term)
+        end = bisect.bisect_left(self.vocabulary, term + "￿")
+        return self.vocabulary[start:end]
+
+    def search(self, query, limit=None):
+        # Returns [(submission_id, score)] best first
+        terms = tokenize(query)
+        with self.lock:
+            doc_count = len(self.doc_lengths)
+            if not terms or not doc_count:
+                return []
+            average_length = self.total_length / doc_count or 1
+
+            scores = defaultdict(float)
+            for position, term in enumerate(terms):
+                is_last = position == len(terms) - 1
+                for token in (self.expand(term) if is_last and len(term) >= 2 else [term]):
+                    postings = self.postings.get(token)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for doc_id, count in postings.items():
+                        norm = K1 * (1 - B + B * self.doc_lengths[doc_id] / average_length)
+                        scores[doc_id] += idf * count * (K1 + 1) / (count + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked[:limit] if limit else ranked
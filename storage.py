@@ -0,0 +1,1076 @@
+import hashlib
+import itertools
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import Counter, deque
+
+import gspread
+import pandas as pd
+import requests
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol, rowcol_to_a1
+from oauth2client.service_account import ServiceAccountCredentials
+
+HEADERS = [
+    'Submission_ID', 'Line_Number', 'Date_Submitted', 'Task',
+    'Spare_Parts_Data', 'Priority', 'Notes', 'Status',
+    'Submitted_By_Engineer', 'Expected_Due_Date', 'Troubleshooting_Steps',
+    'Assigned_Engineer', 'Date_Resolved', 'Resolution_Notes'
+]
+
+INDEXED_COLUMNS = ['Status', 'Line_Number', 'Priority', 'Assigned_Engineer']
+
+DATE_COLUMNS = ['Date_Submitted', 'Expected_Due_Date', 'Date_Resolved']
+
+DATE_FORMAT = "%d/%m/%Y"
+
+SPREADSHEET_KEY = "1urBkSsjlV2rO-uPbwbyKcjE_fl2lGnRD6tgNQEcXIMc"
+
+# Worksheet holding the last allocated Submission_ID and the change version of every site
+COUNTER_SHEET = "ID_Counters"
+COUNTER_HEADERS = ['Site', 'Last_Submission_ID', 'Version']
+
+GOOGLE_SCOPE = ['https://spreadsheets.google.com/feeds',
+                'https://www.googleapis.com/auth/drive']
+
+logger = logging.getLogger("factory_tracker.storage")
+
+
+def read_setting(settings, name, default):
+    # A setting from st.secrets (or any mapping), converted to the type of its default
+    try:
+        return type(default)(settings.get(name, default))
+    except Exception:
+        return default
+
+
+def build_update_ranges(row_updates):
+    # Consecutive columns of the same row are written as one range, e.g. L5:N5
+    data = []
+    for row_number, updates in row_updates.items():
+        cols = sorted(updates)
+        run = [cols[0]] if cols else []
+        for col in cols[1:] + [None]:
+            if col is not None and col == run[-1] + 1:
+                run.append(col)
+                continue
+            data.append({
+                'range': f"{rowcol_to_a1(row_number, run[0])}:{rowcol_to_a1(row_number, run[-1])}",
+                'values': [[updates[c] for c in run]]
+            })
+            run = [col]
+    return data
+
+
+def appended_row_number(response):
+    # append_row reports where the row landed, e.g. "'Sakr'!A42:N42"
+    first_cell = response['updates']['updatedRange'].split('!')[-1].split(':')[0]
+    return a1_to_rowcol(first_cell)[0]
+
+
+def new_version():
+    return f"{time.time():.6f}"
+
+
+def read_counters(all_values):
+    # {site: (worksheet row, last allocated ID, version)} from the values of the ID_Counters worksheet
+    counters = {}
+    for row_number, row in enumerate(all_values[1:], start=2):
+        if row and row[0]:
+            counters[row[0]] = (row_number, int(row[1]) if len(row) > 1 and str(row[1]).isdigit() else 0,
+                                row[2] if len(row) > 2 else "")
+    return counters
+
+
+def counter_update(counter_row, version, last_id=None):
+    # The cells of a site's ID_Counters row that change with a write: the version, plus the last allocated
+    # ID when the writer is the one keeping the counter
+    if last_id is None:
+        return {'range': f"C{counter_row}", 'values': [[version]]}
+    return {'range': f"B{counter_row}:C{counter_row}", 'values': [[last_id, version]]}
+
+
+def values_frame(all_values):
+    # A worksheet's values as text in HEADERS order with integer IDs (blank or malformed -> 0); the index
+    # is the sheet row minus 2
+    header = all_values[0] if all_values else HEADERS
+    rows = [row[:len(header)] + [""] * (len(header) - len(row)) for row in all_values[1:]]
+    df = pd.DataFrame(rows, columns=header).reindex(columns=HEADERS, fill_value="")
+    df['Submission_ID'] = pd.to_numeric(df['Submission_ID'], errors='coerce').fillna(0).astype(int)
+    return df
+
+
+def read_row_index(sheet):
+    # {submission_id: worksheet row} from one read of column A
+    return {int(value): row_number for row_number, value in enumerate(sheet.col_values(1), start=1)
+            if row_number > 1 and str(value).strip().isdigit()}
+
+
+def locate_rows(sheet, problem_ids, known_rows, reread=None):
+    # {submission_id: worksheet row}. The rows a cache knows are confirmed with one read of just their ID
+    # cells; when one moved or is unknown, column A is read again and handed to reread(row_index), so the
+    # cache can catch up.
+    rows = {problem_id: known_rows[problem_id] for problem_id in problem_ids if problem_id in known_rows}
+    if len(rows) == len(problem_ids):
+        try:
+            id_cells = sheet.batch_get([f"A{row}" for row in rows.values()])
+        except gspread.exceptions.APIError as e:
+            # Once rows were deleted a known row can lie past the end of the grid, which Sheets refuses
+            if is_retryable(e):
+                raise
+        else:
+            if all(cell and cell[0] and str(cell[0][0]) == str(problem_id)
+                   for problem_id, cell in zip(rows, id_cells)):
+                return rows
+
+    row_index = read_row_index(sheet)
+    if reread is not None:
+        reread(row_index)
+    missing = [problem_id for problem_id in problem_ids if problem_id not in row_index]
+    if missing:
+        raise KeyError(f"Problem(s) not found in sheet: {', '.join(f'#{i}' for i in missing)}")
+    return {problem_id: row_index[problem_id] for problem_id in problem_ids}
+
+
+def append_rows(sheet, rows, retried=False):
+    # Appends rows that carry their Submission_IDs and returns {submission_id: worksheet row}. An append
+    # that failed may still have landed, so a retried one first reads column A and skips the IDs already
+    # there. Once the append went through nothing may fail the write, or it would be appended again: a
+    # response without the rows' position leaves them out, and they are found from column A when next needed.
+    found = {}
+    if retried:
+        row_index = read_row_index(sheet)
+        found = {int(data[0]): row_index[int(data[0])] for data in rows if int(data[0]) in row_index}
+        if found:
+            logger.warning("Skipped rows %s already appended to %s", list(found), sheet.title)
+        rows = [data for data in rows if int(data[0]) not in found]
+        if not rows:
+            return found
+    response = sheet.append_rows(rows)
+    try:
+        first_row = appended_row_number(response)
+    except Exception as e:
+        logger.warning("Could not tell where the rows appended to %s landed: %s", sheet.title, e)
+        return found
+    return {**found, **{int(data[0]): first_row + offset for offset, data in enumerate(rows)}}
+
+
+def append_with_backoff(append):
+    # with_backoff for append(retried), whose every attempt after the first is a retry
+    attempt = itertools.count()
+    return with_backoff(lambda: append(next(attempt) > 0))
+
+
+def write_rows(backend, sheet, rows, row_updates, counter=None):
+    # Writes row_updates ({submission_id: {column number: value}}) into the located rows in one request;
+    # counter, an ID_Counters cell update from counter_update, goes out in that same request
+    ranges = build_update_ranges({rows[problem_id]: updates for problem_id, updates in row_updates.items()})
+    if counter is None:
+        sheet.batch_update(ranges, value_input_option='USER_ENTERED')
+    else:
+        backend.batch_update_values({sheet.title: ranges, COUNTER_SHEET: [counter]}, value_input_option='USER_ENTERED')
+
+
+def apply_write(op, payload, append, update, allocate, retried=False):
+    # Applies one outbox entry through the caller's append(rows, retried) and update(row_updates). Rows
+    # queued without a Submission_ID get one from allocate(count) first; the payload keeps it, so a retry
+    # appends the same ID and can tell whether the failed attempt landed.
+    if op in ('append', 'append_rows'):
+        rows = [payload] if op == 'append' else payload
+        missing = [data for data in rows if not str(data[0]).strip()]
+        if missing:
+            for data, new_id in zip(missing, allocate(len(missing))):
+                data[0] = str(new_id)
+        append(rows, retried and not missing)
+    elif op == 'update':
+        update({int(problem_id): {int(col): value for col, value in updates.items()}
+                for problem_id, updates in payload.items()})
+    else:
+        raise ValueError(f"Unknown write: {op}")
+
+
+def renumber_duplicate_ids(sheet, df, allocate):
+    # Two writers that read the ID counter at the same moment hand out the same ID, as Sheets has no
+    # compare-and-set. In df (index = sheet row - 2) the first row keeps the ID and every later copy gets a
+    # new one from allocate(count), written only where column A still holds the duplicate. Returns
+    # {worksheet row: new ID}.
+    duplicated = df['Submission_ID'].duplicated(keep='first') & (df['Submission_ID'] > 0)
+    if not duplicated.any():
+        return {}
+    rows = dict(zip((df.index[duplicated] + 2).tolist(), df.loc[duplicated, 'Submission_ID'].tolist()))
+    current = sheet.batch_get([f"A{row}" for row in rows])
+    rows = {row: old_id for (row, old_id), cell in zip(rows.items(), current)
+            if cell and cell[0] and str(cell[0][0]) == str(old_id)}
+    if not rows:
+        return {}
+    
+    new_ids = dict(zip(rows, allocate(len(rows))))
+    try:
+        sheet.batch_update([{'range': f"A{row}", 'values': [[new_id]]} for row, new_id in new_ids.items()])
+    except Exception:
+        logger.warning("IDs %s were allocated for duplicates in %s but not written; they stay unused",
+                       list(new_ids.values()), sheet.title)
+        raise
+    for row, new_id in new_ids.items():
+        logger.warning("Renumbered duplicate Submission_ID %s in %s row %d to %s", rows[row], sheet.title, row, new_id)
+    return new_ids
+
+
+class BackendError(Exception):
+    pass
+
+
+class QuotaExceededError(BackendError):
+    pass
+
+
+class TransientBackendError(BackendError):
+    pass
+
+
+class PendingWritesError(BackendError):
+    # Routes a write through the outbox while earlier writes for the same site are still queued
+    pass
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    # Quota (429) and server-side or network failures go away on their own; anything else needs a person
+    if isinstance(error, (QuotaExceededError, TransientBackendError, PendingWritesError,
+                          requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return getattr(error.response, 'status_code', None) in RETRYABLE_STATUS_CODES
+    return False
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=300.0):
+    # Exponential backoff with jitter so workers that failed together do not retry together
+    delay = min(max_delay, base_delay * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def with_backoff(func, attempts=3, base_delay=0.5, max_delay=8.0):
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts - 1 or not is_retryable(e):
+                raise
+            time.sleep(backoff_delay(attempt, base_delay, max_delay))
+
+
+class SheetsBackend:
+    # A spreadsheet holding one worksheet per site. Worksheets returned by open_worksheet support the
+    # gspread Worksheet calls the app uses: get_all_values, get, batch_get, col_values, acell,
+    # append_row, append_rows, update_cell and batch_update.
+
+    def open_worksheet(self, title, headers, rows=1000, cols=20):
+        raise NotImplementedError
+
+    def worksheet_titles(self):
+        raise NotImplementedError
+
+    def delete_rows(self, sheet, spans):
+        # Deletes the [first, last] row spans (1-based, inclusive) of a worksheet in one request
+        raise NotImplementedError
+
+    def batch_update_values(self, data, value_input_option='RAW'):
+        # data: {worksheet title: [{'range', 'values'}]}, written to several worksheets in one request
+        raise NotImplementedError
+
+
+class GoogleSheetsBackend(SheetsBackend):
+
+    def __init__(self, credentials_dict, spreadsheet_key):
+        creds = ServiceAccountCredentials.from_json_keyfile_dict(credentials_dict, GOOGLE_SCOPE)
+        self.client = gspread.authorize(creds)
+        self.spreadsheet = self.client.open_by_key(spreadsheet_key)
+
+    def open_worksheet(self, title, headers, rows=1000, cols=20):
+        try:
+            sheet = self.spreadsheet.worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            sheet = self.spreadsheet.add_worksheet(title=title, rows=str(rows), cols=str(cols))
+            sheet.append_row(headers)
+            return sheet
+        # Worksheets created before a column was added to their headers are widened in place
+        if sheet.col_count < len(headers):
+            sheet.add_cols(len(headers) - sheet.col_count)
+        return sheet
+
+    def worksheet_titles(self):
+        return [sheet.title for sheet in self.spreadsheet.worksheets()]
+
+    def delete_rows(self, sheet, spans):
+        # Bottom-up, so earlier deletions do not shift the rows of later ones
+        requests = [{"deleteDimension": {"range": {"sheetId": sheet.id, "dimension": "ROWS",
+                                                   "startIndex": first - 1, "endIndex": last}}}
+                    for first, last in sorted(spans, reverse=True)]
+        return self.spreadsheet.batch_update({"requests": requests})
+
+    def batch_update_values(self, data, value_input_option='RAW'):
+        return self.spreadsheet.values_batch_update({
+            'valueInputOption': value_input_option,
+            'data': [{'range': f"'{title}'!{update['range']}", 'values': update['values']}
+                     for title, updates in data.items() for update in updates]
+        })
+
+
+class MemorySheetsBackend(SheetsBackend):
+    # Offline stand-in for Google Sheets with optional per-call latency, a per-minute request quota
+    # and random transient failures, for load tests and benchmarks
+
+    def __init__(self, latency=0.0, quota_per_minute=None, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.quota_per_minute = quota_per_minute
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.worksheets = {}
+        self.request_times = deque()
+        self.calls = Counter()
+
+    def request(self, name):
+        # Every worksheet call is one API request: count it, enforce the quota, then wait out the latency
+        with self.lock:
+            now = time.monotonic()
+            while self.request_times and now - self.request_times[0] >= 60:
+                self.request_times.popleft()
+            if self.quota_per_minute is not None and len(self.request_times) >= self.quota_per_minute:
+                self.calls['quota_exceeded'] += 1
+                raise QuotaExceededError(f"429: Quota exceeded ({self.quota_per_minute} requests per minute)")
+            self.request_times.append(now)
+            self.calls[name] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+        
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise TransientBackendError(f"503: {name} failed")
+
+    def open_worksheet(self, title, headers, rows=1000, cols=20):
+        with self.lock:
+            sheet = self.worksheets.get(title)
+            if sheet is None:
+                sheet = self.worksheets[title] = MemoryWorksheet(self, title, rows)
+                sheet.rows.append([str(value) for value in headers])
+            return sheet
+
+    def worksheet_titles(self):
+        self.request('worksheets')
+        with self.lock:
+            return list(self.worksheets)
+
+    def delete_rows(self, sheet, spans):
+        self.request('delete_rows')
+        with self.lock:
+            for first, last in sorted(spans, reverse=True):
+                del sheet.rows[first - 1:last]
+                sheet.row_count -= last - first + 1
+
+    def batch_update_values(self, data, value_input_option='RAW'):
+        self.request('batch_update_values')
+        with self.lock:
+            for title, updates in data.items():
+                sheet = self.worksheets[title]
+                for update in updates:
+                    first_row, _, first_col, _ = sheet.grid(update['range'])
+                    sheet.write(first_row, first_col, update['values'])
+
+    def load_values(self, title, all_values):
+        sheet = self.open_worksheet(title, [])
+        with self.lock:
+            sheet.rows = [[str(value) for value in row] for row in all_values]
+            sheet.row_count = len(sheet.rows)
+        return sheet
+
+
+def grid_limit_error(title, a1_range, row_count):
+    # The 400 Sheets answers a range past the end of the grid with, as gspread raises it
+    response = requests.Response()
+    response.status_code = 400
+    response._content = json.dumps({"error": {
+        "code": 400, "status": "INVALID_ARGUMENT",
+        "message": f"Range ('{title}'!{a1_range.split('!')[-1]}) exceeds grid limits. Max rows: {row_count}"
+    }}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def create_backend(settings):
+    # The backend SHEETS_BACKEND names, configured from the app's settings; used by the app and the sync service
+    if read_setting(settings, "SHEETS_BACKEND", "google") == "memory":
+        backend = MemorySheetsBackend(latency=read_setting(settings, "MEMORY_LATENCY_SECONDS", 0.0),
+                                      quota_per_minute=read_setting(settings, "MEMORY_QUOTA_PER_MINUTE", 0) or None,
+                                      error_rate=read_setting(settings, "MEMORY_ERROR_RATE", 0.0))
+        seed_path = read_setting(settings, "MEMORY_SEED_PATH", "")
+        if seed_path:
+            with open(seed_path, encoding="utf-8") as f:
+                for title, all_values in json.load(f).items():
+                    backend.load_values(title, all_values)
+        return backend
+    return GoogleSheetsBackend(json.loads(settings["GOOGLE_SHEET_CREDENTIALS"]), SPREADSHEET_KEY)
+
+
+class MemoryWorksheet:
+    # rows holds the values; row_count is the size of the grid, which appends grow and deleted rows shrink
+
+    def __init__(self, backend, title, row_count=1000):
+        self.backend = backend
+        self.title = title
+        self.rows = []
+        self.row_count = row_count
+
+    def grid(self, a1_range):
+        # Like the Sheets API, a range reaching past the last row of the grid is refused
+        grid = a1_range_to_grid_range(a1_range.split('!')[-1])
+        first_row, last_row = grid.get('startRowIndex', 0), grid.get('endRowIndex', len(self.rows))
+        if max(first_row + 1, last_row) > self.row_count:
+            raise grid_limit_error(self.title, a1_range, self.row_count)
+        return first_row, last_row, grid.get('startColumnIndex', 0), grid.get('endColumnIndex')
+
+    def read(self, a1_range):
+        # Like the Sheets API: trailing empty rows and cells are not returned
+        first_row, last_row, first_col, last_col = self.grid(a1_range)
+        values = []
+        for row in self.rows[first_row:last_row]:
+            cells = list(row[first_col:last_col])
+            while cells and cells[-1] == "":
+                cells.pop()
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def write(self, first_row, first_col, values):
+        for row_offset, row_values in enumerate(values):
+            row_number = first_row + row_offset
+            while len(self.rows) <= row_number:
+                self.rows.append([])
+            row = self.rows[row_number]
+            for col_offset, value in enumerate(row_values):
+                col = first_col + col_offset
+                row.extend([""] * (col + 1 - len(row)))
+                row[col] = str(value)
+
+    def get_all_values(self):
+        self.backend.request('get_all_values')
+        with self.backend.lock:
+            width = max((len(row) for row in self.rows), default=0)
+            return [row + [""] * (width - len(row)) for row in self.rows]
+
+    def get(self, a1_range):
+        self.backend.request('get')
+        with self.backend.lock:
+            return self.read(a1_range)
+
+    def batch_get(self, ranges):
+        self.backend.request('batch_get')
+        with self.backend.lock:
+            return [self.read(a1_range) for a1_range in ranges]
+
+    def col_values(self, col):
+        self.backend.request('col_values')
+        with self.backend.lock:
+            values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def acell(self, label):
+        self.backend.request('acell')
+        with self.backend.lock:
+            values = self.read(label)
+        row, col = a1_to_rowcol(label)
+        return gspread.Cell(row, col, values[0][0] if values and values[0] else None)
+
+    def append_rows(self, values, value_input_option='RAW'):
+        self.backend.request('append_rows')
+        with self.backend.lock:
+            last_row = len(self.rows)
+            while last_row and not any(self.rows[last_row - 1]):
+                last_row -= 1
+            self.write(last_row, 0, values)
+            self.row_count = max(self.row_count, len(self.rows))
+            width = max((len(row) for row in values), default=1)
+            updated_range = f"'{self.title}'!A{last_row + 1}:{rowcol_to_a1(last_row + len(values), width)}"
+        return {'updates': {'updatedRange': updated_range, 'updatedRows': len(values)}}
+
+    def append_row(self, values, value_input_option='RAW'):
+        return self.append_rows([values], value_input_option)
+
+    def update_cell(self, row, col, value):
+        self.backend.request('update_cell')
+        with self.backend.lock:
+            first_row, _, first_col, _ = self.grid(rowcol_to_a1(row, col))
+            self.write(first_row, first_col, [[value]])
+
+    def batch_update(self, data, value_input_option='RAW'):
+        self.backend.request('batch_update')
+        with self.backend.lock:
+            for update in data:
+                first_row, _, first_col, _ = self.grid(update['range'])
+                self.write(first_row, first_col, update['values'])
+        return {'totalUpdatedCells': sum(len(row) for update in data for row in update['values'])}
+
+
+class WriteQueue:
+    # Persistent outbox of writes waiting to be pushed to Sheets, in per-site order
+
+    def __init__(self, path, owner=True):
+        # The owner is the one process that pushes the outbox; other processes sharing the file only add to it
+        self.path = path
+        self.owner = owner
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.create_schema()
+
+    def create_schema(self):
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    site TEXT NOT NULL,
+                    op TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    last_error TEXT
+                );
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")]
+            if 'claimed' not in columns:
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN claimed INTEGER NOT NULL DEFAULT 0")
+            # A failed write is one Sheets refused for good; it waits for a person and blocks nothing
+            if 'failed' not in columns:
+                self.conn.execute("ALTER TABLE outbox ADD COLUMN failed INTEGER NOT NULL DEFAULT 0")
+            # Writes claimed by a worker that died before finishing are retried
+            if self.owner:
+                self.conn.execute("UPDATE outbox SET claimed = 0")
+
+    def enqueue(self, site, op, payload, attempts=0):
+        # Caller holds the lock. attempts is 1 for an append whose direct attempt failed, as it may still
+        # have landed: pushing it then checks column A first. An update is merged into the site's last queued write when that write is an
+        # update no worker has picked up yet, so a burst of edits to the same rows costs one Sheets request.
+        if op == 'update':
+            last = self.conn.execute(
+                "SELECT id, op, payload, claimed FROM outbox WHERE site = ? AND failed = 0 ORDER BY id DESC LIMIT 1",
+                (site,)
+            ).fetchone()
+            if last is not None and last[1] == 'update' and not last[3]:
+                merged = json.loads(last[2])
+                for problem_id, updates in payload.items():
+                    merged.setdefault(problem_id, {}).update(updates)
+                self.conn.execute("UPDATE outbox SET payload = ? WHERE id = ?", (json.dumps(merged), last[0]))
+                return
+        self.conn.execute("INSERT INTO outbox (site, op, payload, attempts) VALUES (?, ?, ?, ?)",
+                          (site, op, json.dumps(payload), attempts))
+
+    def queue_append(self, site, data, attempts=0):
+        with self.lock:
+            self.enqueue(site, 'append', [str(value) for value in data], attempts)
+
+    def queue_append_rows(self, site, rows, attempts=0):
+        with self.lock:
+            self.enqueue(site, 'append_rows', [[str(value) for value in data] for data in rows], attempts)
+
+    def queue_update(self, site, row_updates):
+        # row_updates: {submission_id: {column_number: value}}
+        with self.lock:
+            self.enqueue(site, 'update', {str(problem_id): {str(col): value for col, value in updates.items()}
+                                          for problem_id, updates in row_updates.items()})
+
+    def pending_writes(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, site, op, attempts, next_attempt_at FROM outbox WHERE failed = 0 ORDER BY id"
+            ).fetchall()
+
+    def claim(self, write_id):
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET claimed = 1 WHERE id = ?", (write_id,))
+            row = self.conn.execute("SELECT payload FROM outbox WHERE id = ?", (write_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def complete(self, write_id, payload=None):
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (write_id,))
+
+    def retry_later(self, write_id, error, delay, payload=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ?, last_error = ?, claimed = 0, "
+                "payload = COALESCE(?, payload) WHERE id = ?",
+                (time.time() + delay, error, None if payload is None else json.dumps(payload), write_id)
+            )
+
+    def fail(self, write_id, error, payload=None):
+        with self.lock:
+            self.conn.execute(
+                "UPDATE outbox SET failed = 1, claimed = 0, last_error = ?, payload = COALESCE(?, payload) WHERE id = ?",
+                (error, None if payload is None else json.dumps(payload), write_id)
+            )
+
+    def failed_writes(self):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT id, site, op, payload, last_error FROM outbox WHERE failed = 1 ORDER BY id"
+            ).fetchall()
+
+    def retry_failed(self, write_id):
+        # A write that was attempted before is still pushed as a retry, in case one of its attempts landed
+        with self.lock:
+            self.conn.execute("UPDATE outbox SET failed = 0, attempts = MIN(attempts, 1), next_attempt_at = 0 "
+                              "WHERE id = ?", (write_id,))
+
+    def pending_count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM outbox WHERE failed = 0").fetchone()[0]
+
+    def has_pending(self, site):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM outbox WHERE site = ? AND failed = 0 LIMIT 1", (site,)
+            ).fetchone() is not None
+
+    def last_error(self):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT last_error FROM outbox WHERE last_error IS NOT NULL AND failed = 0 ORDER BY id LIMIT 1"
+            ).fetchone()
+        return row[0] if row else None
+
+
+class SQLiteMirror(WriteQueue):
+    # Local copy of every site's worksheet, sharing its database with the outbox. In shared mode several
+    # app processes use the same file: they also allocate IDs from it and ask the sync service for pulls.
+
+    def create_schema(self):
+        super().create_schema()
+        columns = ",\n".join(
+            f"{column} INTEGER NOT NULL" if column == 'Submission_ID' else f"{column} TEXT NOT NULL DEFAULT ''"
+            for column in HEADERS
+        )
+        # Rows are not keyed by Submission_ID: the sheet can hold the same ID twice, or none at all, and the
+        # mirror keeps every row it pulled
+        problems_table = f"""
+            CREATE TABLE IF NOT EXISTS problems (
+                site TEXT NOT NULL,
+                sheet_row INTEGER,
+                {columns}
+            )
+        """
+        with self.lock:
+            self.conn.executescript(f"""
+                {problems_table};
+                CREATE TABLE IF NOT EXISTS sites (
+                    site TEXT PRIMARY KEY,
+                    synced_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS counters (
+                    site TEXT PRIMARY KEY,
+                    last_id INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS site_requests (
+                    site TEXT PRIMARY KEY,
+                    requested_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS pull_errors (
+                    site TEXT PRIMARY KEY,
+                    error TEXT NOT NULL,
+                    failed_at REAL NOT NULL
+                );
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(sites)")]
+            if 'version' not in columns:
+                self.conn.execute("ALTER TABLE sites ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+            # Fingerprint of the rows last pulled, so a pull that brought no changes keeps the version
+            if 'digest' not in columns:
+                self.conn.execute("ALTER TABLE sites ADD COLUMN digest TEXT NOT NULL DEFAULT ''")
+            # Files made when (site, Submission_ID) was the primary key get the table rebuilt without it
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if any(row[5] for row in self.conn.execute("PRAGMA table_info(problems)")):
+                    self.conn.execute("ALTER TABLE problems RENAME TO problems_keyed")
+                    self.conn.execute(problems_table)
+                    self.conn.execute("INSERT INTO problems SELECT * FROM problems_keyed")
+                    self.conn.execute("DROP TABLE problems_keyed")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_problems_submission_id ON problems (site, Submission_ID)")
+            for column in INDEXED_COLUMNS:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_problems_{column.lower()} ON problems (site, {column})")
+
+    def has_site(self, site):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM sites WHERE site = ?", (site,)).fetchone() is not None
+
+    def sites(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT site FROM sites")]
+
+    def site_versions(self):
+        # {site: version}; the version changes with every pull that brought changes and every local write
+        with self.lock:
+            return dict(self.conn.execute("SELECT site, version FROM sites"))
+
+    def bump_version(self, site):
+        # Caller holds the lock
+        self.conn.execute("UPDATE sites SET version = ? WHERE site = ?", (new_version(), site))
+
+    def request_site(self, site):
+        # Asks the process that talks to Sheets to pull the site soon
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO site_requests (site, requested_at) VALUES (?, ?)",
+                              (site, time.time()))
+
+    def requested_sites(self):
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT site FROM site_requests ORDER BY requested_at")]
+
+    def set_pull_error(self, site, error):
+        # Kept until the site is pulled again, so app processes can show why it is stale or missing
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO pull_errors (site, error, failed_at) VALUES (?, ?, ?)",
+                              (site, error, time.time()))
+
+    def pull_error(self, site):
+        with self.lock:
+            row = self.conn.execute("SELECT error FROM pull_errors WHERE site = ?", (site,)).fetchone()
+        return row[0] if row else None
+
+    def wait_for_site(self, site, timeout):
+        deadline = time.time() + timeout
+        while not self.has_site(site):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.2)
+        return True
+
+    def seed_counter(self, site, last_id):
+        # The counter only ever moves up, so seeding from an older source never hands out an ID twice
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO counters (site, last_id) VALUES (?, ?) "
+                "ON CONFLICT (site) DO UPDATE SET last_id = MAX(last_id, excluded.last_id)",
+                (site, int(last_id))
+            )
+
+    def highest_id(self, site):
+        with self.lock:
+            row = self.conn.execute("SELECT MAX(Submission_ID) FROM problems WHERE site = ?", (site,)).fetchone()
+        return row[0] or 0
+
+    def last_id(self, site):
+        with self.lock:
+            row = self.conn.execute("SELECT last_id FROM counters WHERE site = ?", (site,)).fetchone()
+        return row[0] if row else 0
+
+    def allocate_ids(self, site, count=1):
+        # One transaction across every process sharing the file, so two workers never get the same ID
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute("SELECT last_id FROM counters WHERE site = ?", (site,)).fetchone()
+                if row is None:
+                    row = self.conn.execute("SELECT COALESCE(MAX(Submission_ID), 0) FROM problems WHERE site = ?",
+                                            (site,)).fetchone()
+                last_id = row[0]
+                self.conn.execute("INSERT OR REPLACE INTO counters (site, last_id) VALUES (?, ?)",
+                                  (site, last_id + count))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return list(range(last_id + 1, last_id + count + 1))
+
+    def sheet_rows(self, site, problem_ids):
+        # {submission_id: worksheet row} for the problems whose row is known
+        with self.lock:
+            return dict(self.conn.execute(
+                f"SELECT Submission_ID, sheet_row FROM problems WHERE site = ? AND sheet_row IS NOT NULL "
+                f"AND Submission_ID IN ({', '.join('?' * len(problem_ids))})",
+                (site, *[int(problem_id) for problem_id in problem_ids])
+            ))
+
+    def set_sheet_rows(self, site, rows):
+        with self.lock:
+            self.conn.executemany("UPDATE problems SET sheet_row = ? WHERE site = ? AND Submission_ID = ?",
+                                  [(row, site, int(problem_id)) for problem_id, row in rows.items()])
+
+    def pending_ids(self, site):
+        # IDs of rows with queued writes; a queued append still waiting for its ID holds the placeholder -outbox id
+        ids = set()
+        for write_id, op, payload in self.conn.execute(
+            "SELECT id, op, payload FROM outbox WHERE site = ? AND failed = 0", (site,)
+        ):
+            payload = json.loads(payload)
+            if op in ('append', 'append_rows'):
+                for row in (payload if op == 'append_rows' else [payload]):
+                    ids.add(int(row[0]) if str(row[0]).isdigit() else -write_id)
+            else:
+                ids.update(int(problem_id) for problem_id in payload)
+        return ids
+
+    def replace_site(self, site, df, version=None):
+        # Rows with writes still waiting in the outbox keep their local version. The site's version only
+        # changes when the pulled rows did: to the given version, or a new one when that is not new.
+        rows = df.assign(sheet_row=df.index + 2)[['sheet_row'] + HEADERS]
+        for column in DATE_COLUMNS:
+            if pd.api.types.is_datetime64_any_dtype(rows[column]):
+                rows[column] = rows[column].dt.strftime(DATE_FORMAT).fillna("")
+        placeholders = ", ".join("?" * (len(HEADERS) + 2))
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                pending = self.pending_ids(site)
+                rows = rows[~rows['Submission_ID'].isin(pending)]
+                digest = hashlib.sha1(pd.util.hash_pandas_object(rows.astype(str)).values.tobytes()).hexdigest()
+                previous = self.conn.execute("SELECT version, digest FROM sites WHERE site = ?", (site,)).fetchone()
+                if previous is not None and previous[1] == digest:
+                    version = previous[0]
+                elif not version or (previous is not None and previous[0] == version):
+                    version = new_version()
+                self.conn.execute(
+                    f"DELETE FROM problems WHERE site = ? AND Submission_ID NOT IN ({', '.join('?' * len(pending))})",
+                    (site, *pending)
+                )
+                self.conn.executemany(
+                    f"INSERT INTO problems (site, sheet_row, {', '.join(HEADERS)}) VALUES ({placeholders})",
+                    [(site, *row) for row in rows.astype(object).itertuples(index=False, name=None)]
+                )
+                self.conn.execute("INSERT OR REPLACE INTO sites (site, synced_at, version, digest) VALUES (?, ?, ?, ?)",
+                                  (site, time.time(), version, digest))
+                self.conn.execute("DELETE FROM site_requests WHERE site = ?", (site,))
+                self.conn.execute("DELETE FROM pull_errors WHERE site = ?", (site,))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def query(self, site, **filters):
+        # Rows in sheet order, filtered in SQL: each filter is one value or a list of them, and None or "All"
+        # leaves its column unfiltered
+        clauses, params = ["site = ?"], [site]
+        for column, value in filters.items():
+            if column not in HEADERS:
+                raise ValueError(f"Unknown column: {column}")
+            if value is None or value == "All":
+                continue
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            clauses.append(f"{column} IN ({', '.join('?' * len(values))})")
+            params.extend(values)
+        sql = (f"SELECT {', '.join(HEADERS)} FROM problems WHERE {' AND '.join(clauses)} "
+               f"ORDER BY sheet_row IS NULL, sheet_row, Submission_ID")
+        with self.lock:
+            return pd.read_sql_query(sql, self.conn, params=params)
+
+    def count_by(self, site, columns):
+        # Row counts per combination of the given columns, as a Series indexed by them
+        if any(column not in HEADERS for column in columns):
+            raise ValueError(f"Unknown columns: {columns}")
+        sql = (f"SELECT {', '.join(columns)}, COUNT(*) AS count FROM problems WHERE site = ? "
+               f"GROUP BY {', '.join(columns)}")
+        with self.lock:
+            counts = pd.read_sql_query(sql, self.conn, params=[site])
+        return counts.set_index(columns)['count']
+
+    def read_site(self, site):
+        return self.query(site)
+
+    def append(self, site, data, attempts=0):
+        self.append_rows(site, [data], op='append', attempts=attempts)
+
+    def append_rows(self, site, rows, op='append_rows', attempts=0):
+        # op 'append' queues a single row, 'append_rows' queues the rows as one multi-row append. A single
+        # row may come without an ID (it is allocated when pushed); until then the mirror keys it by the
+        # placeholder -outbox id.
+        rows = [[str(value) for value in data] for data in rows]
+        if op == 'append_rows' and not all(data[0].isdigit() for data in rows):
+            raise ValueError("Rows appended together need their Submission_IDs")
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.enqueue(site, op, rows[0] if op == 'append' else rows, attempts)
+                write_id = self.conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+                self.conn.executemany(
+                    f"INSERT INTO problems (site, sheet_row, {', '.join(HEADERS)}) "
+                    f"VALUES ({', '.join('?' * (len(HEADERS) + 2))})",
+                    [(site, None, int(data[0]) if data[0].isdigit() else -write_id, *data[1:]) for data in rows]
+                )
+                self.bump_version(site)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def complete(self, write_id, payload=None):
+        # A pushed append that got its ID on the way swaps its placeholder for that ID
+        with self.lock:
+            self.conn.execute("DELETE FROM outbox WHERE id = ?", (write_id,))
+            if payload and not isinstance(payload, dict) and str(payload[0]).isdigit():
+                self.conn.execute("UPDATE problems SET Submission_ID = ? WHERE Submission_ID = ?",
+                                  (int(payload[0]), -write_id))
+
+    def update(self, site, row_updates):
+        # row_updates: {submission_id: {column_number: value}}
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for problem_id, updates in row_updates.items():
+                    assignments = ", ".join(f"{HEADERS[col - 1]} = ?" for col in updates)
+                    self.conn.execute(
+                        f"UPDATE problems SET {assignments} WHERE site = ? AND Submission_ID = ?",
+                        (*[str(value) for value in updates.values()], site, int(problem_id))
+                    )
+                self.enqueue(site, 'update', {str(problem_id): {str(col): value for col, value in updates.items()}
+                                              for problem_id, updates in row_updates.items()})
+                self.bump_version(site)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+
+class SiteVersions:
+    # The last version read from ID_Counters for every site. Writers bump the version when they allocate
+    # IDs, just before appending the rows, so a site whose version changed stays awaited, and is synced on
+    # every poll, until a sync has loaded its highest allocated ID or await_seconds have passed.
+
+    def __init__(self, await_seconds=60):
+        self.await_seconds = await_seconds
+        self.seen = {}
+        self.awaiting = {}
+
+    def observe(self, site, last_id, version):
+        # Returns True when the version changed since the last poll; the first version seen for a site is
+        # only recorded
+        previous = self.seen.get(site)
+        self.seen[site] = version
+        if previous is None or previous == version:
+            return False
+        self.awaiting[site] = (last_id, time.time())
+        return True
+
+    def wrote(self, site, version):
+        # A version this process wrote itself is not a change to sync
+        self.seen[site] = version
+
+    def synced(self, site, highest_id):
+        # Called after syncing an awaited site; highest_id None means the site is not loaded here at all
+        awaited_id, since = self.awaiting[site]
+        if highest_id is None or highest_id >= awaited_id or time.time() - since >= self.await_seconds:
+            del self.awaiting[site]
+
+
+class ChangeWatcher(threading.Thread):
+    # Calls poll() every interval seconds; poll returns the sites whose data changed, and sessions
+    # waiting on any of those sites are woken up
+
+    def __init__(self, poll, interval=15):
+        super().__init__(name="sheets-watch", daemon=True)
+        self.poll = poll
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.generations = {}
+        self.last_error = None
+
+    def generation(self, sites):
+        with self.condition:
+            return tuple(self.generations.get(site, 0) for site in sites)
+
+    def wait(self, sites, seen, timeout):
+        # True once any of the sites changed after `seen` was taken, False on timeout
+        with self.condition:
+            return self.condition.wait_for(lambda: self.generation(sites) != seen, timeout)
+
+    def run(self):
+        while True:
+            try:
+                changed = self.poll()
+                self.last_error = None
+            except Exception as e:
+                changed = []
+                self.last_error = str(e)
+            if changed:
+                with self.condition:
+                    for site in changed:
+                        self.generations[site] = self.generations.get(site, 0) + 1
+                    self.condition.notify_all()
+            time.sleep(self.interval)
+
+
+class SyncWorker(threading.Thread):
+    # Pushes queued writes to Sheets in per-site order, backing off on failures, and refreshes mirrored sites
+
+    def __init__(self, queue, push, pull=None, pull_interval=60, max_retry_delay=300):
+        super().__init__(name="sheets-sync", daemon=True)
+        self.queue = queue
+        self.push = push
+        self.pull = pull
+        self.pull_interval = pull_interval
+        self.max_retry_delay = max_retry_delay
+        self.last_pull = {}
+        self.last_error = None
+        self.wake = threading.Event()
+
+    def notify(self):
+        self.wake.set()
+
+    def flush(self):
+        now = time.time()
+        blocked_sites = set()
+        for write_id, site, op, attempts, next_attempt_at in self.queue.pending_writes():
+            # Keep per-site order: while a write waits for its retry, later writes for that site wait too
+            if site in blocked_sites:
+                continue
+            if next_attempt_at > now:
+                blocked_sites.add(site)
+                continue
+            payload = self.queue.claim(write_id)
+            try:
+                self.push(site, op, payload, attempts > 0)
+                self.queue.complete(write_id, payload)
+            except Exception as e:
+                # push may have filled in part of the payload (e.g. an allocated ID); keep it for the retry.
+                # A write that can never succeed is set aside so later writes for its site still go out.
+                if not is_retryable(e):
+                    self.queue.fail(write_id, f"{type(e).__name__}: {e}", payload)
+                    continue
+                self.queue.retry_later(write_id, str(e), backoff_delay(attempts, max_delay=self.max_retry_delay), payload)
+                blocked_sites.add(site)
+
+    def refresh(self):
+        # Mirrored sites are pulled every pull_interval; sites another process asked for are pulled right away
+        if self.pull is None:
+            return
+        now = time.time()
+        requested = self.queue.requested_sites()
+        for site in dict.fromkeys(requested + self.queue.sites()):
+            if site not in requested and now - self.last_pull.get(site, 0) < self.pull_interval:
+                continue
+            self.last_pull[site] = now
+            try:
+                self.pull(site)
+            except Exception as e:
+                # The site keeps its last pulled rows; the error stays on record until a pull succeeds
+                logger.warning("Could not pull %s: %s", site, e)
+                self.last_error = f"{site}: {e}"
+                self.queue.set_pull_error(site, f"{type(e).__name__}: {e}")
+            else:
+                self.last_error = None
+
+    def run(self):
+        while True:
+            self.flush()
+            self.refresh()
+            self.wake.wait(1)
+            self.wake.clear()
@@ -0,0 +1,170 @@
+import argparse
+import logging
+import threading
+import time
+
+import streamlit as st
+
+from storage import (COUNTER_HEADERS, COUNTER_SHEET, HEADERS, ChangeWatcher, SiteVersions, SQLiteMirror, SyncWorker,
+                     append_rows, appended_row_number, apply_write, counter_update, create_backend, is_retryable,
+                     locate_rows, new_version, read_counters, read_setting, renumber_duplicate_ids, values_frame,
+                     write_rows)
+
+# Runs next to one or more app processes started with STORAGE_BACKEND = "shared". It is the only process
+# that talks to Google Sheets: it mirrors the sites into the shared SQLite file, pushes the outbox the app
+# processes write to, and keeps the ID counters in both places in step. Settings come from the same
+# .streamlit/secrets.toml as the app.
+
+logger = logging.getLogger("factory_tracker.sync")
+
+
+class SyncService:
+    # Everything that reads or writes Sheets in shared mode; one lock keeps pulls, pushes and version
+    # polls from interleaving. Rows are located through the mirror's sheet_row column, and this process
+    # keeps the ID counter in Sheets in step with the mirror's.
+
+    def __init__(self, backend, mirror, await_seconds=60):
+        self.backend = backend
+        self.mirror = mirror
+        self.lock = threading.RLock()
+        self.worksheets = {}
+        self.counter_rows = {}
+        self.versions = SiteVersions(await_seconds)
+        # Sites whose counter row could not be written after a push; retried on every version poll
+        self.stale_counters = set()
+
+    def worksheet(self, site):
+        if site not in self.worksheets:
+            self.worksheets[site] = self.backend.open_worksheet(site, HEADERS)
+        return self.worksheets[site]
+
+    def counter_sheet(self):
+        if COUNTER_SHEET not in self.worksheets:
+            self.worksheets[COUNTER_SHEET] = self.backend.open_worksheet(COUNTER_SHEET, COUNTER_HEADERS, cols=3)
+        return self.worksheets[COUNTER_SHEET]
+
+    def pull(self, site):
+        with self.lock:
+            df = values_frame(self.worksheet(site).get_all_values())
+            self.mirror.seed_counter(site, df['Submission_ID'].max() if len(df) else 0)
+            self.reassign_duplicate_ids(site, df)
+            self.mirror.replace_site(site, df, self.versions.seen.get(site))
+        logger.info("Pulled %s (%d rows)", site, len(df))
+
+    def reassign_duplicate_ids(self, site, df):
+        # A deployment outside this one can hand out an ID that is already in use; the copies get new IDs
+        # from the shared counter before the site is mirrored. A failed attempt is retried on the next pull.
+        try:
+            new_ids = renumber_duplicate_ids(self.worksheet(site), df,
+                                             lambda count: self.mirror.allocate_ids(site, count))
+        except Exception as e:
+            if is_retryable(e):
+                logger.warning("Could not renumber the duplicate IDs in %s yet: %s", site, e)
+            else:
+                logger.exception("Could not renumber the duplicate IDs in %s", site)
+            return
+        if new_ids:
+            df.loc[[row - 2 for row in new_ids], 'Submission_ID'] = list(new_ids.values())
+            self.bump_counter(site)
+
+    def poll_versions(self):
+        # One read of the counter sheet seeds the shared ID counters and pulls the mirrored sites another
+        # deployment changed
+        changed = []
+        with self.lock:
+            for site in list(self.stale_counters):
+                self.bump_counter(site)
+            for site, (row_number, last_id, version) in read_counters(self.counter_sheet().get_all_values()).items():
+                self.counter_rows[site] = row_number
+                self.mirror.seed_counter(site, last_id)
+                self.versions.observe(site, last_id, version)
+                if site not in self.versions.awaiting:
+                    continue
+                if not self.mirror.has_site(site):
+                    self.versions.synced(site, None)
+                    continue
+                self.pull(site)
+                changed.append(site)
+                self.versions.synced(site, self.mirror.highest_id(site))
+        return changed
+
+    def bump_counter(self, site):
+        # Writes the shared counter and a new version into the site's ID_Counters row in one request, so
+        # other deployments and the next allocation after a restart stay ahead of every ID handed out.
+        # The write it follows has already landed, so a failure here only marks the counter for a retry.
+        version = new_version()
+        last_id = self.mirror.last_id(site)
+        try:
+            counter_sheet = self.counter_sheet()
+            if site in self.counter_rows:
+                counter_sheet.batch_update([counter_update(self.counter_rows[site], version, last_id)])
+            else:
+                self.counter_rows[site] = appended_row_number(counter_sheet.append_row([site, last_id, version]))
+        except Exception as e:
+            logger.warning("Could not update the ID_Counters row of %s: %s", site, e)
+            self.stale_counters.add(site)
+            return
+        self.stale_counters.discard(site)
+        self.versions.wrote(site, version)
+
+    def resolve_rows(self, site, problem_ids):
+        return locate_rows(self.worksheet(site), problem_ids, self.mirror.sheet_rows(site, problem_ids),
+                           reread=lambda row_index: self.mirror.set_sheet_rows(site, row_index))
+
+    def append(self, site, rows, retried=False):
+        self.mirror.set_sheet_rows(site, append_rows(self.worksheet(site), rows, retried))
+        self.bump_counter(site)
+
+    def update(self, site, row_updates):
+        rows = self.resolve_rows(site, list(row_updates))
+        counter_row = self.counter_rows.get(site)
+        if counter_row is None or site in self.stale_counters:
+            write_rows(self.backend, self.worksheet(site), rows, row_updates)
+            self.bump_counter(site)
+            return
+        # The rows and the counter row in one request
+        version = new_version()
+        write_rows(self.backend, self.worksheet(site), rows, row_updates,
+                   counter=counter_update(counter_row, version, self.mirror.last_id(site)))
+        self.versions.wrote(site, version)
+
+    def push(self, site, op, payload, retried=False):
+        with self.lock:
+            apply_write(op, payload,
+                        append=lambda rows, retried: self.append(site, rows, retried),
+                        update=lambda row_updates: self.update(site, row_updates),
+                        allocate=lambda count: self.mirror.allocate_ids(site, count),
+                        retried=retried)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shared Google Sheets sync service for app processes running "
+                                                 "with STORAGE_BACKEND = \"shared\"")
+    parser.add_argument("sites", nargs="*", help="sites to mirror right away (others are mirrored when first viewed)")
+    parser.add_argument("--pull-interval", type=float, default=read_setting(st.secrets, "DATA_TTL_SECONDS", 60),
+                        help="seconds between full pulls of every mirrored site")
+    parser.add_argument("--poll-interval", type=float, default=read_setting(st.secrets, "LIVE_REFRESH_SECONDS", 15),
+                        help="seconds between reads of the ID_Counters versions")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    mirror = SQLiteMirror(read_setting(st.secrets, "SQLITE_PATH", "factory_tracker.db"))
+    service = SyncService(create_backend(st.secrets), mirror, await_seconds=args.pull_interval)
+    service.poll_versions()
+    for site in args.sites:
+        service.pull(site)
+
+    worker = SyncWorker(mirror, push=service.push, pull=service.pull, pull_interval=args.pull_interval)
+    watcher = ChangeWatcher(service.poll_versions, interval=args.poll_interval)
+    worker.start()
+    watcher.start()
+    logger.info("Syncing %s", mirror.path)
+
+    while True:
+        time.sleep(60)
+        error = mirror.last_error() or worker.last_error or watcher.last_error
+        logger.info("%d write(s) waiting%s", mirror.pending_count(), f", last error: {error}" if error else "")
+
+
+if __name__ == "__main__":
+    main()
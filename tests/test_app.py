@@ -0,0 +1,458 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+from datetime import date
+
+import gspread
+import pytest
+import requests
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+
+import storage
+from storage import COUNTER_HEADERS, COUNTER_SHEET, HEADERS, MemorySheetsBackend, SQLiteMirror, TransientBackendError
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "App.py")
+SITE = "Faragallah"
+
+
+def problem(submission_id, task="Conveyor stopped", status="🔴 OPEN", parts="N/A"):
+    return [str(submission_id), "Line 3", "18/10/2026", task, parts, "High", "N/A", status,
+            "Ahmed Hassan", "20/10/2026", "N/A", "", "", ""]
+
+
+def resolved(submission_id, task="Conveyor stopped", date_resolved="19/10/2026"):
+    return problem(submission_id, task, "🟢 RESOLVED")[:11] + ["Omar Mahmoud", date_resolved, "Replaced the belt"]
+
+
+def api_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b'{"error": {"code": %d, "message": "Sheets said no"}}' % status_code
+    return gspread.exceptions.APIError(response)
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = MemorySheetsBackend()
+    backend.load_values(SITE, [HEADERS, problem(1), problem(2, status="🟢 RESOLVED"), problem(3), problem(4)])
+    backend.load_values(COUNTER_SHEET, [COUNTER_HEADERS, [SITE, "4", "v1"]])
+    monkeypatch.setattr(storage, "create_backend", lambda settings: backend)
+    return backend
+
+
+def start_app(tmp_path, **secrets):
+    # Snapshots go stale after a second, so a later run resyncs the one the first run loaded
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.secrets["STORAGE_BACKEND"] = "sheets"
+    at.secrets["SQLITE_PATH"] = str(tmp_path / "app.db")
+    at.secrets["METRICS_LOG"] = ""
+    at.secrets["DATA_TTL_SECONDS"] = 1
+    for name, value in secrets.items():
+        at.secrets[name] = value
+    at.run()
+    assert not at.exception
+    return at
+
+
+@pytest.fixture
+def app(backend, tmp_path):
+    yield start_app(tmp_path)
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+
+@pytest.fixture
+def mirrored_app(backend, tmp_path, monkeypatch):
+    # sqlite mode, logging every run's timings. Its sync worker stops with the test, so it cannot fill the
+    # caches of the next one.
+    stopped = threading.Event()
+    workers = []
+
+    def run_until_stopped(worker):
+        workers.append(worker)
+        while not stopped.is_set():
+            worker.flush()
+            worker.refresh()
+            stopped.wait(1)
+    monkeypatch.setattr(storage.SyncWorker, "run", run_until_stopped)
+    yield start_app(tmp_path, STORAGE_BACKEND="sqlite", METRICS_LOG=str(tmp_path / "metrics.jsonl"))
+    stopped.set()
+    for worker in workers:
+        worker.join()
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+
+def last_run_timings(tmp_path):
+    with open(tmp_path / "metrics.jsonl", encoding="utf-8") as f:
+        return json.loads(f.readlines()[-1])["timings"]
+
+
+def dashboard_tasks(at):
+    df = at.dataframe[0].value
+    return dict(zip(df['Submission_ID'].astype(int), df['Task']))
+
+
+def resync(at):
+    time.sleep(1.1)
+    at.run()
+    assert not at.exception
+
+
+def open_page(at, page):
+    next(radio for radio in at.sidebar.radio if radio.label == "Navigation").set_value(page)
+    at.run()
+    assert not at.exception
+
+
+def open_update_page(at):
+    open_page(at, "✅ Update Problem Status")
+
+
+def test_resync_reads_only_new_and_active_rows(app, backend):
+    sheet = backend.worksheets[SITE]
+    sheet.rows[3][3] = "Changed in Sheets"
+    sheet.append_row(problem(5, task="Added elsewhere"))
+    backend.calls.clear()
+
+    resync(app)
+    assert dashboard_tasks(app) == {1: "Conveyor stopped", 3: "Changed in Sheets", 4: "Conveyor stopped",
+                                    5: "Added elsewhere"}
+    assert backend.calls['batch_get'] == 1
+    assert backend.calls['get_all_values'] == 0
+
+
+def test_resync_reloads_the_sheet_after_rows_moved(app, backend):
+    backend.delete_rows(backend.worksheets[SITE], [(2, 2)])
+    backend.calls.clear()
+
+    resync(app)
+    assert set(dashboard_tasks(app)) == {3, 4}
+    assert backend.calls['get_all_values'] == 1
+
+
+def test_resync_of_a_sheet_that_fills_its_grid(app, backend):
+    # Nothing changed and the grid ends on the last row, so the read of new rows must not start past it
+    backend.calls.clear()
+
+    resync(app)
+    assert set(dashboard_tasks(app)) == {1, 3, 4}
+    assert backend.calls['batch_get'] == 1
+    assert backend.calls['get_all_values'] == 0
+
+
+def test_resync_reloads_the_sheet_after_the_last_row_was_deleted(app, backend):
+    backend.delete_rows(backend.worksheets[SITE], [(5, 5)])
+    backend.calls.clear()
+
+    resync(app)
+    assert set(dashboard_tasks(app)) == {1, 3}
+    assert backend.calls['get_all_values'] == 1
+
+
+def test_duplicate_ids_are_renumbered_and_logged(app, backend, caplog):
+    # Two processes handed out #3 at once
+    sheet = backend.worksheets[SITE]
+    sheet.rows[4][0] = "3"
+
+    with caplog.at_level(logging.WARNING):
+        resync(app)
+    assert sheet.rows[4][0] == "5"
+    assert backend.worksheets[COUNTER_SHEET].rows[1][1] == "5"
+    assert set(dashboard_tasks(app)) == {1, 3, 5}
+    assert f"Renumbered duplicate Submission_ID 3 in {SITE} row 5 to 5" in caplog.text
+
+
+def test_duplicate_ids_sheets_refuses_to_renumber_are_logged(app, backend, caplog, monkeypatch):
+    sheet = backend.worksheets[SITE]
+    sheet.rows[4][0] = "3"
+
+    def refused(data, value_input_option='RAW'):
+        raise api_error(403)
+    monkeypatch.setattr(sheet, "batch_update", refused)
+
+    with caplog.at_level(logging.WARNING):
+        resync(app)
+    assert sheet.rows[4][0] == "3"
+    assert any(record.levelno == logging.ERROR and f"duplicate IDs in {SITE}" in record.getMessage()
+               for record in caplog.records)
+
+
+def test_update_finds_the_problem_after_rows_moved(app, backend, monkeypatch):
+    # AppTest replays the click on st.rerun(); without it the notice shows on the next run instead
+    monkeypatch.setattr(st, "rerun", lambda: None)
+    # Keep serving the first snapshot, so its row index is stale once a row is deleted
+    app.secrets["DATA_TTL_SECONDS"] = 600
+    open_update_page(app)
+    choose = next(box for box in app.selectbox if box.label == "Choose Problem")
+    choose.set_value(next(label for label in choose.options if label.startswith("ID #4 ")))
+    app.run()
+
+    # Row 2 is deleted in Sheets after the page was loaded, so problem #4 is one row higher
+    sheet = backend.worksheets[SITE]
+    backend.delete_rows(sheet, [(2, 2)])
+    next(box for box in app.selectbox if box.label == "New Status").set_value("🟡 IN PROGRESS")
+    next(text for text in app.text_input if text.label == "Assigned Engineer Name *").input("Omar")
+    next(button for button in app.button if "UPDATE STATUS" in button.label).click()
+    app.run()
+    app.run()
+
+    assert not app.exception
+    assert [s.value for s in app.success] == ["✅ Problem #4 updated successfully!"]
+    assert sheet.rows[3][0] == "4"
+    assert sheet.rows[3][7] == "🟡 IN PROGRESS"
+    assert sheet.rows[3][11] == "Omar"
+
+
+def test_history_page_is_pulled_back_when_fewer_pages_remain(app, backend):
+    backend.load_values(SITE, [HEADERS] + [resolved(i) for i in range(1, 301)])
+    resync(app)
+    open_page(app, "📜 History")
+    app.number_input(key="hist_page").set_value(20)
+    app.run()
+
+    next(box for box in app.selectbox if box.label == "Problems per page").set_value(100)
+    app.run()
+    assert not app.exception
+    assert app.number_input(key="hist_page").value == 3
+    assert not app.warning
+
+
+def test_submit_does_not_append_twice_when_a_failed_append_landed(app, backend, monkeypatch):
+    sheet = backend.worksheets[SITE]
+    append_rows = sheet.append_rows
+
+    def lands_then_fails(values, value_input_option='RAW'):
+        # The first append reaches Sheets but its response is lost
+        monkeypatch.setattr(sheet, "append_rows", append_rows)
+        append_rows(values, value_input_option)
+        raise TransientBackendError("503: append_rows failed")
+    monkeypatch.setattr(sheet, "append_rows", lands_then_fails)
+
+    open_page(app, "➕ Submit New Problem")
+    next(text for text in app.text_area if text.label == "Task Description *").input("Gearbox leaking")
+    next(button for button in app.button if "SUBMIT PROBLEM" in button.label).click()
+    app.run()
+
+    assert not app.exception
+    assert [s.value for s in app.success] == ["✅ Problem #5 submitted successfully!"]
+    assert [row[0] for row in sheet.rows] == ["Submission_ID", "1", "2", "3", "4", "5"]
+
+
+@pytest.fixture
+def archivable(backend, tmp_path, monkeypatch):
+    monkeypatch.setattr(st, "rerun", lambda: None)
+    backend.load_values(SITE, [HEADERS, problem(1), resolved(2, date_resolved="05/01/2025"),
+                               resolved(3, date_resolved="20/02/2025"), problem(4),
+                               resolved(5, date_resolved=date.today().strftime("%d/%m/%Y"))])
+    app = start_app(tmp_path, ARCHIVE_AFTER_DAYS=30)
+    open_page(app, "📜 History")
+    yield app
+    st.cache_resource.clear()
+    st.cache_data.clear()
+
+
+def archive_ids(backend, month):
+    return [row[0] for row in backend.worksheets[f"{SITE} Archive {month}"].rows[1:]]
+
+
+def test_archive_moves_old_resolved_problems_into_monthly_worksheets(archivable, backend):
+    archivable.button(key="archive_now").click()
+    archivable.run()
+
+    assert not archivable.exception
+    assert [s.value for s in archivable.success] == ["✅ 2 resolved problems archived!"]
+    assert archive_ids(backend, "2025-01") == ["2"]
+    assert archive_ids(backend, "2025-02") == ["3"]
+    assert [row[0] for row in backend.worksheets[SITE].rows[1:]] == ["1", "4", "5"]
+    assert backend.calls['delete_rows'] == 1
+
+
+def test_archive_sends_the_delete_once_and_a_rerun_finishes_the_job(archivable, backend, monkeypatch):
+    delete_rows = backend.delete_rows
+    deletes = []
+
+    def unavailable(sheet, spans):
+        deletes.append(spans)
+        raise TransientBackendError("503: delete_rows failed")
+    monkeypatch.setattr(backend, "delete_rows", unavailable)
+    archivable.button(key="archive_now").click()
+    archivable.run()
+
+    assert deletes == [[[3, 4]]]
+    assert [e.value for e in archivable.error] == ["❌ Error archiving problems: 503: delete_rows failed"]
+    assert [row[0] for row in backend.worksheets[SITE].rows[1:]] == ["1", "2", "3", "4", "5"]
+
+    monkeypatch.setattr(backend, "delete_rows", delete_rows)
+    archivable.button(key="archive_now").click()
+    archivable.run()
+
+    assert [s.value for s in archivable.success] == ["✅ 2 resolved problems archived!"]
+    assert archive_ids(backend, "2025-01") == ["2"]
+    assert archive_ids(backend, "2025-02") == ["3"]
+    assert [row[0] for row in backend.worksheets[SITE].rows[1:]] == ["1", "4", "5"]
+
+
+def parts_demand_table(at):
+    df = at.dataframe[0].value
+    return dict(zip(df['Part_Number'], df['Quantity']))
+
+
+def test_parts_demand_follows_edits_to_the_parts_of_a_problem(app, backend):
+    sheet = backend.worksheets[SITE]
+    sheet.rows[3][4] = "SP-1:Bearing:Qty2:Stock-No"
+    sheet.rows[4][4] = "SP-1:Bearing:Qty1:Stock-No | SP-2:Belt:Qty1:Stock-Yes"
+    resync(app)
+    open_page(app, "🔧 Parts Demand")
+    assert parts_demand_table(app) == {"SP-1": 3, "SP-2": 1}
+
+    sheet.rows[4][4] = "SP-2:Belt:Qty4:Stock-Yes"
+    resync(app)
+    assert parts_demand_table(app) == {"SP-1": 2, "SP-2": 4}
+
+
+def test_parts_are_parsed_again_only_when_the_mirror_changed(mirrored_app, backend, tmp_path):
+    open_page(mirrored_app, "🔧 Parts Demand")
+    assert "dataframe: spare_parts" in last_run_timings(tmp_path)
+
+    # The sync worker pulls the site every second; a pull that brought nothing new keeps the version
+    time.sleep(1.1)
+    mirrored_app.selectbox(key="parts_line").set_value("Line 3")
+    mirrored_app.run()
+    assert not mirrored_app.exception
+    assert "dataframe: spare_parts" not in last_run_timings(tmp_path)
+
+    mirror = SQLiteMirror(str(tmp_path / "app.db"))
+    version = mirror.site_versions()[SITE]
+    backend.worksheets[SITE].rows[3][4] = "SP-1:Bearing:Qty2:Stock-No"
+    deadline = time.time() + 10
+    while mirror.site_versions()[SITE] == version and time.time() < deadline:
+        time.sleep(0.2)
+    mirrored_app.run()
+    assert "dataframe: spare_parts" in last_run_timings(tmp_path)
+    assert parts_demand_table(mirrored_app) == {"SP-1": 2}
+
+
+def dated(row, submitted, due="31/12/2099"):
+    return row[:2] + [submitted] + row[3:9] + [due] + row[10:]
+
+
+def metric_values(at):
+    return {metric.label: metric.value for metric in at.metric}
+
+
+def test_analytics_reports_resolution_times_and_overdue_problems(backend, tmp_path):
+    # Loaded before the app starts: a resync only re-reads active and new rows
+    backend.load_values(SITE, [HEADERS, dated(problem(1), "01/12/2025", due="01/01/2026"),
+                               dated(resolved(2, date_resolved="11/03/2026"), "01/03/2026"),
+                               dated(resolved(3, date_resolved="21/03/2026"), "01/03/2026"),
+                               dated(problem(4), "01/03/2026")])
+    app = start_app(tmp_path)
+    open_page(app, "📈 Analytics")
+
+    metrics = metric_values(app)
+    assert metrics["Resolved (dated)"] == "2"
+    assert metrics["Mean Days to Resolve"] == "15.0"
+    assert metrics["Overdue Active"] == "1"
+    assert app.dataframe[1].value['Submission_ID'].tolist() == [1]
+
+
+def test_analytics_are_not_recomputed_when_the_grouping_changes(mirrored_app, tmp_path):
+    open_page(mirrored_app, "📈 Analytics")
+    assert "dataframe: analytics" in last_run_timings(tmp_path)
+
+    mirrored_app.radio(key="analytics_dimension").set_value("Priority")
+    mirrored_app.run()
+    assert not mirrored_app.exception
+    assert "dataframe: analytics" not in last_run_timings(tmp_path)
+
+
+class UploadedFile(io.BytesIO):
+    def __init__(self, name, lines):
+        super().__init__("\n".join(",".join(line) for line in lines).encode("utf-8"))
+        self.name = name
+        self.file_id = name
+
+
+def upload(monkeypatch, name, rows):
+    # The file uploader cannot be driven from AppTest, so the page gets the file straight away
+    uploaded = UploadedFile(name, [HEADERS] + rows)
+    monkeypatch.setattr(st, "file_uploader", lambda *args, **kwargs: uploaded)
+
+
+def test_import_lists_the_lines_that_need_fixing(app, backend, monkeypatch):
+    upload(monkeypatch, "bad.csv", [problem("", task="Fine"), problem("", task=""),
+                                    problem("", task="Bad date")[:2] + ["31/02/2026"] + problem("")[3:]])
+    open_page(app, "📥 Import Problems")
+
+    errors = app.dataframe[0].value
+    assert errors.values.tolist() == [[3, "Task is empty"], [4, "Date_Submitted is not a DD/MM/YYYY date"]]
+    assert not any(button.key == "import_button" for button in app.button)
+
+
+def test_import_appends_the_file_under_new_ids(app, backend, monkeypatch):
+    upload(monkeypatch, "good.csv", [problem("99", task="First import"), resolved("", task="Second import")])
+    open_page(app, "📥 Import Problems")
+    assert [success.value for success in app.success] == ["✅ 2 problems are ready to import"]
+
+    app.button(key="import_button").click()
+    app.run()
+    assert not app.exception
+    assert "✅ Imported problems #5 to #6!" in [success.value for success in app.success]
+    rows = backend.worksheets[SITE].rows
+    assert [row[:4] for row in rows[-2:]] == [["5", "Line 3", "18/10/2026", "First import"],
+                                             ["6", "Line 3", "18/10/2026", "Second import"]]
+    assert rows[-1][11:] == ["Omar Mahmoud", "19/10/2026", "Replaced the belt"]
+
+    app.run()
+    assert [info.value for info in app.info] == ["✅ This file has already been imported."]
+
+
+def open_bulk_update(at):
+    open_update_page(at)
+    next(radio for radio in at.radio if radio.label == "Update Mode").set_value("📦 Bulk Update")
+    at.run()
+    assert not at.exception
+
+
+def submit_bulk_update(at, *problem_ids):
+    # AppTest matches a multiselect's values against the shown labels, so the picked IDs go in as labels
+    # on the run that submits the form
+    picker = at.multiselect[0]
+    picker.set_value([label for label in picker.options if int(label.split()[1][1:]) in problem_ids])
+    at.button[0].click()
+    at.run()
+    assert not at.exception
+
+
+def test_bulk_update_resolves_the_selected_problems(app, backend):
+    open_bulk_update(app)
+    app.selectbox(key="bulk_status").set_value("🟢 RESOLVED")
+    app.text_input(key="bulk_engineer").set_value("Omar Mahmoud")
+    app.date_input(key="bulk_date_resolved").set_value(date(2026, 10, 19))
+    app.text_area(key="bulk_resolution_notes").set_value("Replaced the belt")
+    submit_bulk_update(app, 1, 3)
+
+    assert [success.value for success in app.success] == ["✅ 2 problems updated successfully!"]
+    rows = backend.worksheets[SITE].rows
+    assert rows[1][7:] == ["🟢 RESOLVED", "Ahmed Hassan", "20/10/2026", "N/A", "Omar Mahmoud", "19/10/2026",
+                           "Replaced the belt"]
+    assert rows[3][7:] == rows[1][7:]
+    assert rows[4] == problem(4)
+
+
+def test_bulk_update_asks_for_an_engineer_where_a_problem_has_none(app, backend):
+    backend.worksheets[SITE].rows[3][11] = "Omar Mahmoud"
+    resync(app)
+    open_bulk_update(app)
+    app.selectbox(key="bulk_status").set_value("🟡 IN PROGRESS")
+    submit_bulk_update(app, 3, 4)
+
+    assert [error.value for error in app.error] == ["⚠️ Assigned engineer name is required for: #4"]
+    assert [row[7] for row in backend.worksheets[SITE].rows[3:5]] == ["🔴 OPEN", "🔴 OPEN"]
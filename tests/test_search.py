@@ -0,0 +1,66 @@
+import pandas as pd
+
+from search import SEARCH_COLUMNS, SearchIndex
+
+
+def problems(tasks):
+    # {submission_id: task} -> a frame holding the searched columns
+    df = pd.DataFrame({'Submission_ID': list(tasks), 'Task': list(tasks.values())})
+    for column in SEARCH_COLUMNS[1:]:
+        df[column] = "N/A"
+    return df
+
+
+def indexed(index):
+    added = []
+    add = index.add
+
+    def record(doc_id, text):
+        added.append(doc_id)
+        add(doc_id, text)
+    index.add = record
+    return added
+
+
+def test_sync_reindexes_only_new_and_changed_rows():
+    index = SearchIndex()
+    added = indexed(index)
+    index.sync(problems({1: "Conveyor belt torn", 2: "Motor bearing noise", 3: "Gearbox oil leak"}))
+    assert sorted(added) == [1, 2, 3]
+
+    added.clear()
+    index.sync(problems({1: "Conveyor belt torn", 2: "Motor overheating", 3: "Gearbox oil leak", 4: "Belt slipping"}))
+    assert sorted(added) == [2, 4]
+    assert [doc_id for doc_id, _ in index.search("bearing")] == []
+    assert [doc_id for doc_id, _ in index.search("overheating")] == [2]
+    assert sorted(doc_id for doc_id, _ in index.search("belt")) == [1, 4]
+
+
+def test_sync_drops_rows_that_left_the_snapshot():
+    index = SearchIndex()
+    index.sync(problems({1: "Conveyor belt torn", 2: "Belt slipping"}))
+    index.sync(problems({2: "Belt slipping"}))
+
+    assert [doc_id for doc_id, _ in index.search("belt")] == [2]
+    assert index.search("conveyor") == []
+    assert index.total_length == index.doc_lengths[2]
+
+
+def test_sync_of_the_same_snapshot_does_nothing():
+    index = SearchIndex()
+    df = problems({1: "Conveyor belt torn"})
+    index.sync(df)
+    added = indexed(index)
+
+    index.sync(df)
+    index.sync(df.copy())
+    assert added == []
+
+
+def test_last_word_matches_as_a_prefix():
+    index = SearchIndex()
+    index.sync(problems({1: "Replaced SP-12345 bearing", 2: "Bearing noise on line 3"}))
+
+    assert [doc_id for doc_id, _ in index.search("sp-123")] == [1]
+    assert sorted(doc_id for doc_id, _ in index.search("bear")) == [1, 2]
+    assert [doc_id for doc_id, _ in index.search("bear replaced")] == [1]
@@ -0,0 +1,323 @@
+import gspread
+import sqlite3
+
+import pandas as pd
+import pytest
+import requests
+
+from storage import (HEADERS, MemorySheetsBackend, QuotaExceededError, SQLiteMirror, SyncWorker, WriteQueue,
+                     append_rows, create_backend, is_retryable, locate_rows, renumber_duplicate_ids)
+
+
+def problem(submission_id, task="Conveyor stopped", status="🔴 OPEN"):
+    return [str(submission_id), "Line 3", "18/10/2026", task, "N/A", "High", "N/A", status,
+            "Ahmed Hassan", "20/10/2026", "N/A", "", "", ""]
+
+
+def site_df(rows):
+    # The frame the app hands to replace_site: index = sheet row - 2
+    df = pd.DataFrame(rows, columns=HEADERS)
+    df['Submission_ID'] = df['Submission_ID'].astype(int)
+    return df
+
+
+def api_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = b'{"error": {"code": %d, "message": "Sheets said no"}}' % status_code
+    return gspread.exceptions.APIError(response)
+
+
+def pushed_by(queue, push):
+    worker = SyncWorker(queue, push=push)
+    worker.flush()
+    return worker
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WriteQueue(str(tmp_path / "outbox.db"))
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = SQLiteMirror(str(tmp_path / "mirror.db"))
+    mirror.replace_site("S", site_df([problem(1), problem(2)]))
+    return mirror
+
+
+def test_updates_merge_into_the_last_unclaimed_update(queue):
+    queue.queue_update("S", {1: {8: "🟡 IN PROGRESS"}})
+    queue.queue_update("S", {1: {12: "Omar"}, 2: {8: "🟢 RESOLVED"}})
+
+    writes = queue.pending_writes()
+    assert len(writes) == 1
+    assert queue.claim(writes[0][0]) == {"1": {"8": "🟡 IN PROGRESS", "12": "Omar"}, "2": {"8": "🟢 RESOLVED"}}
+
+
+def test_update_after_a_claimed_update_is_queued_separately(queue):
+    queue.queue_update("S", {1: {8: "🟡 IN PROGRESS"}})
+    queue.claim(queue.pending_writes()[0][0])
+    queue.queue_update("S", {1: {12: "Omar"}})
+
+    assert queue.pending_count() == 2
+
+
+def test_failed_write_is_set_aside_until_retried(queue):
+    queue.queue_append("S", problem(1))
+    write_id = queue.pending_writes()[0][0]
+    queue.fail(write_id, "APIError: 400")
+
+    assert queue.pending_count() == 0
+    assert not queue.has_pending("S")
+    assert [(row[0], row[4]) for row in queue.failed_writes()] == [(write_id, "APIError: 400")]
+
+    queue.retry_failed(write_id)
+    assert queue.has_pending("S")
+    assert queue.failed_writes() == []
+
+
+def test_flush_keeps_site_order_behind_a_retryable_error(queue):
+    queue.queue_append("A", problem(1))
+    queue.queue_append("A", problem(2))
+    queue.queue_append("B", problem(3))
+    pushed = []
+
+    def push(site, op, payload, retried):
+        if payload[0] == "1":
+            raise QuotaExceededError("429")
+        pushed.append(payload[0])
+
+    pushed_by(queue, push)
+    assert pushed == ["3"]
+    assert queue.pending_count() == 2
+    assert queue.last_error() == "429"
+
+
+def test_flush_sets_aside_rejected_writes_and_carries_on(queue):
+    queue.queue_append("A", problem(1))
+    queue.queue_append("A", problem(2))
+    pushed = []
+
+    def push(site, op, payload, retried):
+        if payload[0] == "1":
+            raise KeyError("Problem(s) not found in sheet: #1")
+        pushed.append(payload[0])
+
+    pushed_by(queue, push)
+    assert pushed == ["2"]
+    assert queue.pending_count() == 0
+    assert len(queue.failed_writes()) == 1
+
+
+def test_flush_pushes_a_write_as_a_retry_once_it_was_attempted(queue):
+    queue.queue_append("A", problem(1))
+    queue.queue_append("B", problem(2), attempts=1)
+    pushed = []
+
+    def push(site, op, payload, retried):
+        pushed.append((payload[0], retried))
+        if len(pushed) == 1:
+            raise QuotaExceededError("429")
+
+    worker = SyncWorker(queue, push=push, max_retry_delay=0)
+    worker.flush()
+    worker.flush()
+    assert pushed == [("1", False), ("2", True), ("1", True)]
+    assert queue.pending_count() == 0
+
+
+def test_retried_append_skips_rows_already_in_the_sheet():
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(2)])
+
+    assert append_rows(sheet, [problem(2), problem(3)], retried=True) == {2: 3, 3: 4}
+    assert [row[0] for row in sheet.rows] == ["Submission_ID", "1", "2", "3"]
+    assert append_rows(sheet, [problem(3)], retried=True) == {3: 4}
+    assert backend.calls['append_rows'] == 1
+
+
+def test_append_without_id_is_rekeyed_once_pushed(mirror):
+    mirror.append("S", problem(""))
+    placeholder = mirror.read_site("S")['Submission_ID'].min()
+    assert placeholder < 0
+
+    def push(site, op, payload, retried):
+        payload[0] = "3"
+
+    pushed_by(mirror, push)
+    assert mirror.read_site("S")['Submission_ID'].tolist() == [1, 2, 3]
+    assert mirror.pending_count() == 0
+
+
+def test_rows_appended_together_need_ids(mirror):
+    with pytest.raises(ValueError):
+        mirror.append_rows("S", [problem(""), problem(4)])
+
+
+def test_replace_site_keeps_rows_with_pending_writes(mirror):
+    mirror.update("S", {1: {8: "🟢 RESOLVED"}})
+    mirror.replace_site("S", site_df([problem(1), problem(2, task="Changed in Sheets")]))
+
+    rows = mirror.read_site("S").set_index('Submission_ID')
+    assert rows.loc[1, 'Status'] == "🟢 RESOLVED"
+    assert rows.loc[2, 'Task'] == "Changed in Sheets"
+
+    pushed_by(mirror, lambda site, op, payload: None)
+    mirror.replace_site("S", site_df([problem(1), problem(2)]))
+    assert mirror.read_site("S").set_index('Submission_ID').loc[1, 'Status'] == "🔴 OPEN"
+
+
+def test_mirror_keyed_by_submission_id_is_rebuilt_without_the_key(tmp_path):
+    path = str(tmp_path / "mirror.db")
+    conn = sqlite3.connect(path)
+    conn.execute(f"CREATE TABLE problems (site TEXT NOT NULL, sheet_row INTEGER, {', '.join(HEADERS)}, "
+                 f"PRIMARY KEY (site, Submission_ID))")
+    conn.execute(f"INSERT INTO problems VALUES ('S', 2, {', '.join('?' * len(HEADERS))})", problem(1))
+    conn.commit()
+    conn.close()
+
+    mirror = SQLiteMirror(path)
+    assert mirror.read_site("S")['Submission_ID'].tolist() == [1]
+    mirror.replace_site("S", site_df([problem(1), problem(1)]))
+    assert mirror.read_site("S")['Submission_ID'].tolist() == [1, 1]
+
+
+def test_replace_site_changes_the_version_only_when_the_rows_changed(mirror):
+    version = mirror.site_versions()["S"]
+    mirror.replace_site("S", site_df([problem(1), problem(2)]))
+    assert mirror.site_versions()["S"] == version
+
+    mirror.replace_site("S", site_df([problem(1), problem(2, task="Edited in Sheets")]), version)
+    assert mirror.site_versions()["S"] != version
+
+
+def test_allocate_ids_is_unique_across_connections(tmp_path):
+    path = str(tmp_path / "shared.db")
+    first, second = SQLiteMirror(path), SQLiteMirror(path, owner=False)
+    first.seed_counter("S", 10)
+
+    ids = first.allocate_ids("S", 2) + second.allocate_ids("S") + first.allocate_ids("S")
+    assert ids == [11, 12, 13, 14]
+
+    # An older source never moves the counter back
+    second.seed_counter("S", 5)
+    assert first.last_id("S") == 14
+
+
+def test_refresh_records_pull_errors_until_a_pull_succeeds(mirror):
+    def failing_pull(site):
+        raise PermissionError("403")
+
+    worker = SyncWorker(mirror, push=None, pull=failing_pull, pull_interval=0)
+    worker.refresh()
+    assert mirror.pull_error("S") == "PermissionError: 403"
+    assert worker.last_error == "S: 403"
+
+    worker.pull = lambda site: mirror.replace_site(site, site_df([problem(1)]))
+    worker.refresh()
+    assert mirror.pull_error("S") is None
+    assert worker.last_error is None
+
+
+def test_memory_backend_enforces_its_quota():
+    backend = MemorySheetsBackend(quota_per_minute=2)
+    sheet = backend.open_worksheet("S", HEADERS)
+    sheet.append_row(problem(1))
+    sheet.col_values(1)
+
+    with pytest.raises(QuotaExceededError):
+        sheet.get_all_values()
+    assert backend.calls['quota_exceeded'] == 1
+
+
+def test_batch_update_values_writes_several_worksheets_in_one_request():
+    backend = MemorySheetsBackend()
+    sheet = backend.open_worksheet("S", HEADERS)
+    counters = backend.open_worksheet("ID_Counters", ['Site', 'Last_Submission_ID', 'Version'])
+    sheet.append_row(problem(1))
+    counters.append_row(["S", "1", "v1"])
+
+    backend.batch_update_values({"S": [{'range': "H2", 'values': [["🟢 RESOLVED"]]}],
+                                 "ID_Counters": [{'range': "C2", 'values': [["v2"]]}]})
+    assert sheet.rows[1][7] == "🟢 RESOLVED"
+    assert counters.rows[1][2] == "v2"
+    assert backend.calls['batch_update_values'] == 1
+
+
+def test_memory_backend_refuses_ranges_past_the_grid():
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(2)])
+    assert sheet.get("A3:A") == [["2"]]
+
+    with pytest.raises(gspread.exceptions.APIError) as error:
+        sheet.get("A4:N")
+    assert not is_retryable(error.value)
+
+    sheet.append_row(problem(3))
+    assert sheet.get("A4:A") == [["3"]]
+    backend.delete_rows(sheet, [(2, 2)])
+    with pytest.raises(gspread.exceptions.APIError):
+        sheet.batch_update([{'range': "A4", 'values': [["4"]]}])
+
+
+def test_create_backend_loads_the_memory_seed(tmp_path):
+    seed_path = tmp_path / "seed.json"
+    seed_path.write_text('{"S": [["Submission_ID"], ["1"], ["2"]]}', encoding="utf-8")
+
+    backend = create_backend({"SHEETS_BACKEND": "memory", "MEMORY_SEED_PATH": str(seed_path)})
+    assert backend.open_worksheet("S", HEADERS).col_values(1) == ["Submission_ID", "1", "2"]
+
+
+def test_locate_rows_rereads_column_a_when_a_known_row_is_past_the_grid(monkeypatch):
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(3)])
+    reread = []
+
+    def past_the_grid(ranges):
+        raise api_error(400)
+    monkeypatch.setattr(sheet, "batch_get", past_the_grid)
+
+    assert locate_rows(sheet, [3], {3: 4}, reread=reread.append) == {3: 3}
+    assert reread == [{1: 2, 3: 3}]
+
+
+def test_locate_rows_does_not_reread_on_a_retryable_error(monkeypatch):
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1)])
+
+    def busy(ranges):
+        raise api_error(429)
+    monkeypatch.setattr(sheet, "batch_get", busy)
+
+    with pytest.raises(gspread.exceptions.APIError):
+        locate_rows(sheet, [1], {1: 2})
+    assert backend.calls['col_values'] == 0
+
+
+def test_renumber_duplicate_ids_allocates_only_for_rows_still_duplicated():
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(2), problem(7)])
+    allocated = []
+
+    def allocate(count):
+        allocated.append(count)
+        return [8]
+
+    # The frame still shows row 4 as a second #2, but the sheet already holds another ID there
+    assert renumber_duplicate_ids(sheet, site_df([problem(1), problem(2), problem(2)]), allocate) == {}
+    assert allocated == []
+
+
+def test_renumber_duplicate_ids_logs_ids_it_could_not_write(monkeypatch, caplog):
+    backend = MemorySheetsBackend()
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(1)])
+
+    def refused(data):
+        raise api_error(403)
+    monkeypatch.setattr(sheet, "batch_update", refused)
+
+    with pytest.raises(gspread.exceptions.APIError):
+        renumber_duplicate_ids(sheet, site_df([problem(1), problem(1)]), lambda count: [5])
+    assert "[5] were allocated" in caplog.text
+    assert sheet.rows[2][0] == "1"
@@ -0,0 +1,124 @@
+import pytest
+
+from storage import (COUNTER_HEADERS, COUNTER_SHEET, HEADERS, MemorySheetsBackend, QuotaExceededError, SQLiteMirror,
+                     SyncWorker)
+from sync_service import SyncService
+
+
+def problem(submission_id, task="Conveyor stopped"):
+    return [str(submission_id), "Line 3", "18/10/2026", task, "N/A", "High", "N/A", "🔴 OPEN",
+            "Ahmed Hassan", "20/10/2026", "N/A", "", "", ""]
+
+
+@pytest.fixture
+def backend():
+    backend = MemorySheetsBackend()
+    backend.load_values("S", [HEADERS] + [problem(i) for i in range(1, 6)])
+    backend.load_values(COUNTER_SHEET, [COUNTER_HEADERS, ["S", "5", "v1"]])
+    return backend
+
+
+@pytest.fixture
+def service(backend, tmp_path):
+    service = SyncService(backend, SQLiteMirror(str(tmp_path / "shared.db")))
+    service.poll_versions()
+    service.pull("S")
+    return service
+
+
+def test_resolve_rows_trusts_the_mirror_while_column_a_agrees(service, backend):
+    backend.calls.clear()
+    assert service.resolve_rows("S", [2, 4]) == {2: 3, 4: 5}
+    assert dict(backend.calls) == {'batch_get': 1}
+
+
+def test_resolve_rows_rereads_column_a_after_rows_moved(service, backend):
+    sheet = backend.worksheets["S"]
+    backend.delete_rows(sheet, [(2, 3)])
+
+    assert service.resolve_rows("S", [4, 5]) == {4: 3, 5: 4}
+    assert service.mirror.sheet_rows("S", [4, 5]) == {4: 3, 5: 4}
+
+
+def test_resolve_rows_reports_problems_missing_from_the_sheet(service, backend):
+    backend.delete_rows(backend.worksheets["S"], [(3, 3)])
+
+    with pytest.raises(KeyError, match="#2"):
+        service.resolve_rows("S", [2])
+
+
+def test_pull_keeps_rows_that_share_an_id_or_have_none(service, backend):
+    backend.load_values("S", [HEADERS] + [problem(submission_id) for submission_id in (1, 2, 2, "", "")])
+    service.pull("S")
+
+    assert len(service.mirror.read_site("S")) == 5
+
+
+def test_pull_renumbers_duplicate_ids_before_mirroring(service, backend):
+    sheet = backend.load_values("S", [HEADERS] + [problem(submission_id) for submission_id in (1, 2, 2, "", "")])
+    service.pull("S")
+
+    assert [row[0] for row in sheet.rows] == ["Submission_ID", "1", "2", "6", "", ""]
+    assert service.mirror.read_site("S")['Submission_ID'].tolist() == [1, 2, 6, 0, 0]
+    assert service.resolve_rows("S", [6]) == {6: 4}
+    assert backend.worksheets[COUNTER_SHEET].rows[1][1] == "6"
+
+
+def test_pull_mirrors_the_duplicates_when_sheets_refuses_to_renumber(service, backend, monkeypatch, caplog):
+    sheet = backend.load_values("S", [HEADERS, problem(1), problem(1)])
+
+    def refused(data, value_input_option='RAW'):
+        raise PermissionError("403: The caller does not have permission")
+    monkeypatch.setattr(sheet, "batch_update", refused)
+    service.pull("S")
+
+    assert service.mirror.read_site("S")['Submission_ID'].tolist() == [1, 1]
+    assert "Could not renumber the duplicate IDs in S" in caplog.text
+
+
+def test_push_allocates_ids_for_rows_queued_without_one(service, backend):
+    service.mirror.append("S", problem(""))
+    SyncWorker(service.mirror, push=service.push).flush()
+
+    assert backend.worksheets["S"].rows[-1][0] == "6"
+    assert service.mirror.read_site("S")['Submission_ID'].tolist() == [1, 2, 3, 4, 5, 6]
+    assert service.resolve_rows("S", [6]) == {6: 7}
+    assert backend.worksheets[COUNTER_SHEET].rows[1][1] == "6"
+
+
+def test_update_writes_rows_and_counter_in_one_request(service, backend):
+    backend.calls.clear()
+    service.push("S", 'update', {"3": {"8": "🟢 RESOLVED"}})
+
+    assert backend.worksheets["S"].rows[3][7] == "🟢 RESOLVED"
+    assert backend.calls['batch_update_values'] == 1
+    assert backend.worksheets[COUNTER_SHEET].rows[1][2] == service.versions.seen["S"]
+
+
+def test_counter_failure_does_not_fail_the_append(service, backend, monkeypatch):
+    counter_sheet = backend.worksheets[COUNTER_SHEET]
+
+    def rejected(*args, **kwargs):
+        raise QuotaExceededError("429")
+    monkeypatch.setattr(counter_sheet, "batch_update", rejected)
+
+    service.push("S", 'append', problem(""))
+    assert len(backend.worksheets["S"].rows) == 7
+    assert service.stale_counters == {"S"}
+
+    monkeypatch.undo()
+    service.poll_versions()
+    assert service.stale_counters == set()
+    assert counter_sheet.rows[1][1] == "6"
+
+
+def test_poll_pulls_until_rows_allocated_elsewhere_arrive(service, backend):
+    # Another deployment allocated #6 and bumped the version, but has not appended the row yet
+    backend.worksheets[COUNTER_SHEET].rows[1][1:3] = ["6", "v2"]
+    assert service.poll_versions() == ["S"]
+    assert "S" in service.versions.awaiting
+
+    backend.worksheets["S"].append_row(problem(6, task="Appended elsewhere"))
+    assert service.poll_versions() == ["S"]
+    assert "S" not in service.versions.awaiting
+    assert service.mirror.highest_id("S") == 6